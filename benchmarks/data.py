@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# DatabaseModel.data() calls per second, the way it used to answer them
+# (making a new icon, font and label for each call) against the way it
+# does now (handing out the ones made when the model and nodes were). A
+# view calls data() several times per visible row, every time it paints.
+#
+# It needs the KDE libraries and a display, for the icons. It has to be
+# run against the real PyQt4 and PyKDE4 to mean anything, since making
+# icons, fonts and variants is what's being measured.
+#
+# Usage: data.py [number of songs]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+os.pardir))
+
+from PyQt4 import QtCore, QtGui
+from PyKDE4 import kdecore, kdeui
+
+from quetzalcoatl import Parser, SongTable, FetchingNode, SongNode,\
+DatabaseModel, AllUris, ALL_SONGS, ALBUMS
+
+
+def label(node):
+    # What nodes used to do for DisplayRole.
+    if isinstance(node, SongNode):
+        return QtCore.QVariant(node.table.title(node.tableRow))
+    if node.nodeData:
+        return QtCore.QVariant(node.nodeData.decode("utf-8"))
+    return QtCore.QVariant()
+
+
+def rebuilt(model, index, role):
+    # DatabaseModel.data as it was.
+    if not index.isValid():
+        return QtCore.QVariant()
+
+    if role == QtCore.Qt.DisplayRole:
+        return label(model.node(index))
+
+    if model.node(index).isLoading():
+        return QtCore.QVariant()
+
+    if model.node(index).isLeaf():
+        if role == QtCore.Qt.DecorationRole:
+            icon = QtGui.QIcon(kdeui.KIcon("audio-x-generic"))
+            return QtCore.QVariant(icon)
+    else:
+        if role == QtCore.Qt.FontRole:
+            font = QtGui.QFont()
+            font.setBold(True)
+            return QtCore.QVariant(font)
+        if role == QtCore.Qt.DecorationRole:
+            icon = QtGui.QIcon(kdeui.KIcon("folder-sound"))
+            return QtCore.QVariant(icon)
+
+    return QtCore.QVariant()
+
+
+def cached(model, index, role):
+    return model.data(index, role)
+
+
+def perSecond(data, model, indexes, roles):
+    calls = 0
+    start = time.time()
+    for index in indexes:
+        for role in roles:
+            data(model, index, role)
+            calls = calls + 1
+    return calls / (time.time() - start)
+
+
+def main():
+    size = 100000
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+
+    aboutData = kdecore.KAboutData("quetzalcoatl-benchmark", "",\
+    kdecore.ki18n("Quetzalcoatl benchmark"), "1.0")
+    kdecore.KCmdLineArgs.init(sys.argv, aboutData)
+    app = kdeui.KApplication()
+
+    # A tab with an "All Songs" node of size songs, and as many albums.
+    root = FetchingNode(ALBUMS)
+    model = DatabaseModel(root, AllUris())
+    table = SongTable()
+    songs = FetchingNode(ALL_SONGS, "All Songs", root)
+    songs.setChildren([SongNode(table, table.append(Parser.normalize(\
+    {"file": "%d.flac" % i, "title": "Song %d" % i})), songs)\
+    for i in xrange(size)])
+    albums = [FetchingNode(ALL_SONGS, "Album %d" % i, root)\
+    for i in xrange(size)]
+    root.setChildren([songs] + albums)
+
+    top = QtCore.QModelIndex()
+    parent = model.index(0, 0, top)
+    leaves = [model.index(row, 0, parent) for row in xrange(size)]
+    folders = [model.index(row, 0, top) for row in xrange(1, size + 1)]
+
+    # What a delegate asks for when it paints a row.
+    roles = (QtCore.Qt.DisplayRole, QtCore.Qt.DecorationRole,\
+    QtCore.Qt.FontRole, QtCore.Qt.ForegroundRole)
+
+    print "%d songs and %d albums, %d roles per row" %\
+    (size, size, len(roles))
+    for name, indexes in (("songs", leaves), ("albums", folders)):
+        before = perSecond(rebuilt, model, indexes, roles)
+        after = perSecond(cached, model, indexes, roles)
+        print "%-7s before: %9.0f calls/s  after: %9.0f calls/s  (%.1fx)" %\
+        (name, before, after, after / before)
+
+
+if __name__ == "__main__":
+    main()
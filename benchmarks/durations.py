@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# DurationIndex, checked and timed against a plain list of lengths summed
+# the way the time label used to be.
+#
+# The check runs random edits of every kind the playlist makes (append,
+# set, insert, delete, move, truncate, extend, and deletes and moves of
+# several scattered runs at once) on both, and after each one compares the
+# lengths and the total and sum of a random range. Then, on a queue of the
+# given size, the time a range takes is measured, and so is deleting every
+# other row, as PlaylistModel.deleteRows does.
+#
+# Usage: durations.py [number of songs [number of edits]]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+os.pardir))
+
+from quetzalcoatl import DurationIndex
+
+
+def edit(durations, times):
+    # One random edit, made to both. Returns the new list.
+    size = len(times)
+    kind = random.randint(0, 8)
+    if kind == 0:
+        length = random.randint(0, 600)
+        durations.append(length)
+        times.append(length)
+    elif kind == 1 and size > 0:
+        row = random.randrange(size)
+        length = random.randint(0, 600)
+        durations.set(row, length)
+        times[row] = length
+    elif kind == 2:
+        row = random.randint(0, size)
+        lengths = [random.randint(0, 600)\
+        for i in xrange(random.randint(0, 5))]
+        durations.insert(row, lengths)
+        times[row:row] = lengths
+    elif kind == 3 and size > 0:
+        start = random.randrange(size)
+        end = random.randint(start, size)
+        durations.delete(start, end)
+        del times[start:end]
+    elif kind == 4 and size > 0:
+        start = random.randrange(size)
+        end = random.randint(start + 1, size)
+        block = times[start:end]
+        rest = times[:start] + times[end:]
+        to = random.randint(0, len(rest))
+        durations.moveRuns([(start, end, to)])
+        times = rest[:to] + block + rest[to:]
+    elif kind == 5:
+        size = random.randint(0, size)
+        durations.truncate(size)
+        del times[size:]
+    elif kind == 6:
+        lengths = [random.randint(0, 600)\
+        for i in xrange(random.randint(0, 9))]
+        durations.extend(lengths)
+        times.extend(lengths)
+    elif kind == 7:
+        runs = scattered(size)
+        durations.deleteRuns(runs)
+        for start, end in runs:
+            del times[start:end]
+    elif kind == 8 and size > 0:
+        moves = []
+        for i in xrange(random.randint(1, 5)):
+            start = random.randrange(size)
+            end = random.randint(start + 1, size)
+            moves.append((start, end, random.randint(0, size - end + start)))
+        durations.moveRuns(moves)
+        for start, end, to in moves:
+            block = times[start:end]
+            del times[start:end]
+            times[to:to] = block
+    return times
+
+
+def scattered(size):
+    # Random runs, from the bottom up, as deleteRows has them.
+    runs = []
+    row = random.randint(0, size)
+    while row > 0:
+        end = row
+        start = random.randint(max(0, end - 3), end - 1)
+        runs.append((start, end))
+        row = start - random.randint(1, 4)
+    return runs
+
+
+def check(edits):
+    random.seed(1)
+    durations = DurationIndex()
+    times = []
+    for i in xrange(edits):
+        # Start over now and then, so that small queues get checked too.
+        if i % 200 == 0:
+            durations = DurationIndex()
+            times = []
+        times = edit(durations, times)
+        size = len(times)
+        start = random.randint(0, size)
+        end = random.randint(start, size)
+        if len(durations) <> size or durations.total() <> sum(times) or\
+        durations.range(start, end) <> sum(times[start:end]):
+            print "edit %d: DurationIndex doesn't match the list" % i
+            sys.exit(1)
+    print "%d random edits checked" % edits
+
+
+def perSecond(function, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        function()
+    return rounds / (time.time() - start)
+
+
+def main():
+    size = 20000
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    edits = 60000
+    if len(sys.argv) > 2:
+        edits = int(sys.argv[2])
+
+    check(edits)
+
+    times = [random.randint(60, 600) for i in xrange(size)]
+    durations = DurationIndex()
+    durations.extend(times)
+    start, end = 1, size - 1
+    before = perSecond(lambda: sum(times[start:end]), 1000)
+    after = perSecond(lambda: durations.range(start, end), 1000)
+    print "%d songs, range before: %9.0f/s  after: %9.0f/s  (%.0fx)" %\
+    (size, before, after, after / before)
+
+    # Every other row, from the bottom up, one run each.
+    runs = [(row, row + 1) for row in xrange(size - 2, -1, -2)]
+    start = time.time()
+    durations.deleteRuns(runs)
+    seconds = time.time() - start
+    print "%d songs, deleting %d runs: %.3fs" % (size, len(runs), seconds)
+
+
+if __name__ == "__main__":
+    main()
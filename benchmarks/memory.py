@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# What the library costs in memory, held three ways: as python-mpd hands it
+# over (a dict of fresh strings per song), as Parser.normalize records, and
+# as a SongTable. The library is synthetic, with the artists, albums and
+# genres repeated the way they are in a real collection.
+#
+# Usage: memory.py [number of songs]
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+os.pardir))
+
+from quetzalcoatl import Parser, SongTable
+
+
+def size(thing, seen):
+    # Deep size in bytes, counting each object once.
+    if id(thing) in seen:
+        return 0
+    seen.add(id(thing))
+    total = sys.getsizeof(thing)
+    if isinstance(thing, dict):
+        for key, value in thing.iteritems():
+            total += size(key, seen) + size(value, seen)
+    elif isinstance(thing, (list, tuple)):
+        for item in thing:
+            total += size(item, seen)
+    elif isinstance(thing, SongTable):
+        total += size(thing.__dict__, seen)
+    return total
+
+
+def fresh(text):
+    # A copy of the string, the way each line off the socket is one.
+    return (" " + text)[1:]
+
+
+def songs(count):
+    random.seed(0)
+    genres = ["Genre %d" % i for i in xrange(40)]
+    artists = ["Artist %d" % i for i in xrange(count // 100 + 1)]
+    for i in xrange(count):
+        artist = i // 100
+        album = i // 12
+        song = {
+            "file": fresh("Artist %d/Album %d/%02d.flac" % (artist, album,\
+            i % 12 + 1)),
+            "title": fresh("Title %d" % i),
+            "artist": fresh(artists[artist]),
+            "album": fresh("Album %d" % album),
+            "genre": fresh(genres[album % len(genres)]),
+            "date": fresh(str(1960 + album % 60)),
+            "track": fresh("%d/12" % (i % 12 + 1)),
+            "time": fresh(str(random.randint(60, 600))),
+            "last-modified": fresh("2012-03-04T05:06:07Z"),
+        }
+        if i % 7 == 0:
+            song["composer"] = fresh("Composer %d" % (i % 300))
+        yield song
+
+
+def main():
+    count = 200000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    raw = list(songs(count))
+    records = [Parser.normalize(song) for song in raw]
+    table = SongTable()
+    for record in records:
+        table.append(record)
+
+    print "%d songs" % count
+    for name, thing in (("raw", raw), ("records", records),\
+    ("table", table)):
+        total = size(thing, set())
+        print "%-8s %8.1f MB, %6d bytes per song" %\
+        (name, total / 1048576.0, total // count)
+
+
+if __name__ == "__main__":
+    main()
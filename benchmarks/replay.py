@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Serves a trace recorded with QUETZALCOATL_RECORD back to Quetzalcoatl, as
+# a stand-in MPD server, so that a session on someone else's library can be
+# profiled here. Point Quetzalcoatl at localhost and the port. A password
+# is accepted, whatever it is, but it's best left out.
+#
+# Each connection we accept is matched to a recorded one by the first
+# command it sends. From then on, we wait for each recorded command and
+# answer it with what was recorded, as long after the command as it took
+# the first time, times the scale. A scale of 0 answers at once. Commands
+# that differ from the recorded ones are reported, but answered all the
+# same.
+#
+# The greeting is sent as soon as a connection is accepted, so it's taken
+# out of the recording. A client that doesn't wait for it, such as the
+# asynchronous one sending its password, can have a command recorded
+# before it.
+#
+# Passwords aren't recorded, so the password commands and their answers are
+# taken out too, and any password we're sent is answered with OK straight
+# away.
+#
+# Usage: replay.py trace [port [scale]]
+
+import json
+import socket
+import sys
+import threading
+import time
+
+
+def load(path):
+    # Returns the recorded connections in order, each a list of
+    # (seconds, direction, data), with their greetings taken out.
+    connections = {}
+    with open(path) as traceFile:
+        for line in traceFile:
+            seconds, connection, direction, data = json.loads(line)
+            events = connections.setdefault(connection, [])
+            events.append((seconds, direction, data.encode("latin-1")))
+    return [withoutPassword(withoutGreeting(connections[connection]))\
+    for connection in sorted(connections)]
+
+
+def withoutGreeting(events):
+    # The greeting is the first line the server sent. It may have arrived
+    # in one piece with more.
+    for i, (seconds, direction, data) in enumerate(events):
+        if direction == "<":
+            if data.startswith("OK MPD "):
+                rest = data.partition("\n")[2]
+                if len(rest) == 0:
+                    return events[:i] + events[i + 1:]
+                return events[:i] + [(seconds, direction, rest)] +\
+                events[i + 1:]
+            break
+    return events
+
+
+def isPassword(line):
+    return line == "password\n" or line.startswith("password ")
+
+
+def withoutPassword(events):
+    # A password is the first command on a connection, so its answer is
+    # the first line received after it. That can have arrived in one
+    # piece with more.
+    kept = []
+    answers = 0
+    for seconds, direction, data in events:
+        if direction == ">" and isPassword(data):
+            answers = answers + 1
+            continue
+        if direction == "<" and answers > 0:
+            answers = answers - 1
+            data = data.partition("\n")[2]
+            if len(data) == 0:
+                continue
+        kept.append((seconds, direction, data))
+    return kept
+
+
+def greeting(path):
+    # The first one recorded. They're all the same.
+    with open(path) as traceFile:
+        for line in traceFile:
+            seconds, connection, direction, data = json.loads(line)
+            data = data.encode("latin-1")
+            if direction == "<" and data.startswith("OK MPD "):
+                return data.partition("\n")[0] + "\n"
+    return "OK MPD 0.15.0\n"
+
+
+class Trace(object):
+
+    # The recorded connections that haven't been claimed yet.
+
+    def __init__(self, connections, greeting):
+        self.connections = connections
+        self.greeting = greeting
+        self.lock = threading.Lock()
+
+    def claim(self, line):
+        # Takes the first unclaimed connection whose first command is line.
+        with self.lock:
+            for events in self.connections:
+                commands = [data for seconds, direction, data in events\
+                if direction == ">"]
+                if len(commands) > 0 and commands[0] == line:
+                    self.connections.remove(events)
+                    return events
+        return None
+
+
+class Session(threading.Thread):
+
+    def __init__(self, sock, trace, scale):
+        super(Session, self).__init__()
+        self.daemon = True
+        self.sock = sock
+        self.trace = trace
+        self.scale = scale
+        self.mismatches = 0
+
+    def run(self):
+        try:
+            self.replay()
+        except socket.error:
+            pass
+        finally:
+            self.sock.close()
+
+    def readCommand(self, readFile):
+        # The next line that isn't a password, which is answered here.
+        line = readFile.readline()
+        while isPassword(line):
+            self.sock.sendall("OK\n")
+            line = readFile.readline()
+        return line
+
+    def replay(self):
+        readFile = self.sock.makefile("rb")
+        self.sock.sendall(self.trace.greeting)
+        line = self.readCommand(readFile)
+        if len(line) == 0:
+            return
+        events = self.trace.claim(line)
+        if events is None:
+            print "no recorded connection starts with %r" % line
+            return
+
+        # The greeting was sent already, and the first command read.
+        first = [direction for seconds, direction, data in events]\
+        .index(">")
+        sent, sentAt = events[first][0], time.time()
+        for seconds, direction, data in events[first + 1:]:
+            if direction == ">":
+                line = self.readCommand(readFile)
+                if len(line) == 0:
+                    return
+                if line != data:
+                    self.mismatches = self.mismatches + 1
+                    print "expected %r, got %r" % (data, line)
+                sent, sentAt = seconds, time.time()
+            else:
+                delay = (seconds - sent) * self.scale -\
+                (time.time() - sentAt)
+                if delay > 0:
+                    time.sleep(delay)
+                self.sock.sendall(data)
+
+        # The recording has run out. Anything else fails.
+        while True:
+            line = self.readCommand(readFile)
+            if len(line) == 0:
+                return
+            self.sock.sendall("ACK [5@0] {} End of the recording\n")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print "Usage: replay.py trace [port [scale]]"
+        sys.exit(1)
+    trace = Trace(load(sys.argv[1]), greeting(sys.argv[1]))
+    port = 6601
+    if len(sys.argv) > 2:
+        port = int(sys.argv[2])
+    scale = 1.0
+    if len(sys.argv) > 3:
+        scale = float(sys.argv[3])
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("localhost", port))
+    server.listen(5)
+    print "Replaying %d connections on port %d" %\
+    (len(trace.connections), port)
+    while True:
+        sock, address = server.accept()
+        Session(sock, trace, scale).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Finding a node's row, the way Node.row() used to (searching the parent's
+# children) against the way it does now (reading the stored position).
+# Qt asks for the parent of an index all the time, so a view that touches
+# every row of a big node does one of these per row.
+#
+# Usage: rows.py [number of children]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+os.pardir))
+
+from quetzalcoatl import Parser, SongTable, FetchingNode, SongNode,\
+ALL_SONGS
+
+
+def searched(node):
+    return node.parent().children.index(node)
+
+
+def stored(node):
+    return node.row()
+
+
+def perRow(lookup, nodes):
+    start = time.time()
+    for node in nodes:
+        lookup(node)
+    return (time.time() - start) / len(nodes)
+
+
+def main():
+    size = 50000
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+
+    root = FetchingNode(ALL_SONGS)
+    parent = FetchingNode(ALL_SONGS, "All Songs", root)
+    table = SongTable()
+    parent.setChildren([SongNode(table,\
+    table.append(Parser.normalize({"file": str(i) + ".mp3"})), parent)\
+    for i in xrange(size)])
+
+    # Searching every row is quadratic, so we time an even sample.
+    sample = parent.children[::max(1, size // 1000)]
+    for node in sample:
+        assert searched(node) == stored(node)
+
+    before = perRow(searched, sample)
+    after = perRow(stored, sample)
+    print "%d children" % size
+    print "searched: %8.3f us per row, %8.3f s per pass" %\
+    (before * 1e6, before * size)
+    print "stored:   %8.3f us per row, %8.3f s per pass" %\
+    (after * 1e6, after * size)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,23 @@
 
 import sys
 import os
+import time
 import types
+import marshal
+import threading
+import Queue
+import heapq
+import itertools
+import array
+import calendar
+import contextlib
+import collections
+import errno
+import bisect
+import json
+import signal
+import urllib
+import traceback
 from PyQt4 import QtCore, QtGui
 from mpd import MPDClient, MPDError
 from PyKDE4 import kdecore, kdeui
@@ -12,80 +28,133 @@ import socket
 
 class Parser(object):
 
+    # Songs come from the server as dicts of strings, or lists of strings
+    # where a tag has several values. normalize() turns each one into a
+    # record as it arrives, once, and the rest of Parser works on records:
+    #
+    #   The tags in TAGS are tuples of their non-blank values, and are left
+    #   out when there are none.
+    #   "track" and "disc" are ints, NO_NUMBER for a missing track.
+    #   "time" is an int, 0 for streams.
+    #   "title" is the title to display, as unicode.
+    #   "sortkey" is (disc, track, lowercased title).
+    #
+    # Anything else is kept as the server sent it.
+
+    TAGS = ("artist", "albumartist", "album", "genre", "composer",\
+    "performer", "date", "name", "comment")
+
+    # Songs without a track number sort after those with one.
+    NO_NUMBER = 32768
+
+    # The tags shown in the queue's tooltips, with their headings.
+    TOOLTIP_TAGS = (("artist", "Artists: "), ("album", "Album: "),\
+    ("genre", "Genre: "), ("composer", "Composer: "))
+
     @classmethod
     def isValid(cls, song):
+        # Works on what the server sends, which also has directories and
+        # playlists in it.
         return "file" in song and len(song["file"].strip()) > 0
 
+    @classmethod
+    def normalize(cls, song):
+        record = {}
+        for key, value in song.iteritems():
+            if key in cls.TAGS:
+                values = cls.values(value)
+                if len(values) > 0:
+                    record[key] = values
+            else:
+                record[key] = value
+        record["track"] = cls.number(song.get("track"))
+        record["disc"] = cls.number(song.get("disc"))
+        if record["disc"] == cls.NO_NUMBER:
+            # A song with no disc number is on the first, and usually only,
+            # one.
+            record["disc"] = 1
+        record["time"] = cls.number(song.get("time"))
+        if record["time"] == cls.NO_NUMBER:
+            record["time"] = 0
+        record["title"] = cls.displayTitle(song)
+        record["sortkey"] = (record["disc"], record["track"],\
+        record["title"].lower())
+        return record
+
+    @classmethod
+    def first(cls, value):
+        if type(value) == types.ListType:
+            return value[0]
+        return value
+
+    @classmethod
+    def values(cls, value):
+        if type(value) <> types.ListType:
+            value = [value]
+        return tuple([v.strip() for v in value if len(v.strip()) > 0])
+
+    @classmethod
+    def number(cls, value):
+        # Track and disc numbers are freeform strings and may or may not
+        # exist. "1/12" and "1" are both common. We also check for
+        # malformed tags.
+
+        if value is None:
+            return cls.NO_NUMBER
+        value = cls.first(value).strip()
+
+        end = 0
+        while end < len(value) and value[end].isdigit():
+            end = end + 1
+        if end == 0:
+            return cls.NO_NUMBER
+        return int(value[0:end])
+
+    @classmethod
+    def displayTitle(cls, song):
+        title = ""
+        if "title" in song:
+            title = cls.first(song["title"]).strip()
+        if len(title) == 0:
+            title = os.path.splitext(os.path.basename(song["file"]))[0]
+        return title.decode("utf-8", "replace")
+
     @classmethod
     def hasKey(cls, song, key):
-        return cls.isValid(song) and key in song
+        return key in song
 
     @classmethod
     def valueList(cls, song, key):
         # Because tags may contain multiple values.
-        # Assumes the key is there.
-        values = set()
-
-        if not cls.hasKey(song, key):
-            return values
-
-        if type(song[key]) == types.ListType:
-            values = set()
-            for value in song[key]:
-                if len(value.strip()) > 0:
-                    values.add(value)
-        else:
-            if len(song[key].strip()) > 0:
-                values.add(song[key])
-        return values
+        return song.get(key, ())
 
     @classmethod
     def match(cls, song, key, value):
-        if not cls.hasKey(song, key):
-            return False
-        return value in cls.valueList(song, key)
+        return value in song.get(key, ())
 
     @classmethod
     def title(cls, song):
-        if cls.hasKey(song, "title"):
-            return song["title"]
-        return os.path.splitext(os.path.basename(song["file"]))[0]
+        return song["title"]
+
+    @classmethod
+    def sortKey(cls, song):
+        return song["sortkey"]
+
+    @classmethod
+    def titleKey(cls, song):
+        return song["sortkey"][2]
 
     @classmethod
     def length(cls, song):
-        return cls.prettyTime(int(song["time"]))
+        return cls.prettyTime(song["time"])
 
     @classmethod
     def track(cls, song):
-        # The "track" key is a freeform string and may or may not exist.
-        # "1/12" and "1" are both common. We also check for malformed tags.
-
-        NO_TRACK = 32768
-        trackNo = 0
-
-        if "track" in song:
-            track = song["track"].strip()
-            if len(track) > 0:
-                found = False
-                index = 0
-                for i in xrange(len(track)):
-                    if not track[i].isdigit():
-                        index = i
-                        found = True
-                        break
-                if found:
-                    if len(track[0: index].strip()) > 0:
-                        trackNo = int(track[0:index])
-                    else:
-                        trackNo = cls.NO_TRACK
-                else:
-                    trackNo = int(track)
-            else:
-                trackNo = NO_TRACK
-        else:
-            trackNo = NO_TRACK
+        return song["track"]
 
-        return trackNo
+    @classmethod
+    def disc(cls, song):
+        return song["disc"]
 
     @classmethod
     def total(cls, status):
@@ -116,49 +185,1014 @@ class Parser(object):
         return cls.prettyTime(cls.elapsed(status)) + "/" \
         + cls.prettyTime(cls.total(status))
 
+    @classmethod
+    def tooltip(cls, song):
+        return u"\n".join([header + cls.parsedValue(song, tag)\
+        for tag, header in cls.TOOLTIP_TAGS if cls.hasKey(song, tag)])
+
     @classmethod
     def parsedValue(cls, song, key):
         # For the tooltips
-        first = True
-        valueString = ""
-        for value in cls.valueList(song, key):
-            if first:
-                first = False
+        return cls.joinValues(cls.valueList(song, key))
+
+    @classmethod
+    def joinValues(cls, values):
+        return u", ".join([value.strip().decode("utf-8") for value in values])
+
+
+class Connection(object):
+
+    # One connection to MPD, made with the settings in Options. It connects
+    # and logs in when it's first used, and again after it's been closed.
+
+    # MPD drops connections that have been quiet for a minute by default,
+    # so one that has been quiet for half that is pinged before it's used.
+    HEALTH_INTERVAL = 30
+
+    def __init__(self, options):
+        self.host = str(options.host)
+        self.port = options.port
+        self.password = None
+        if options.needPassword:
+            self.password = str(options.password)
+        self.mpdClient = None
+        self.lastUsed = 0
+
+    def client(self):
+        # Returns a connected MPDClient. Exceptions are caught in the
+        # calling method.
+        if self.mpdClient is not None and\
+        time.time() - self.lastUsed > Connection.HEALTH_INTERVAL:
+            try:
+                self.mpdClient.ping()
+            except (MPDError, socket.error):
+                self.close()
+        if self.mpdClient is None:
+            mpdClient = MPDClient()
+            mpdClient.connect(self.host, self.port)
+            if Recorder.enabled:
+                Recorder.wrap(mpdClient)
+            if self.password is not None:
+                mpdClient.password(self.password)
+            self.mpdClient = mpdClient
+        self.lastUsed = time.time()
+        return self.mpdClient
+
+    def close(self):
+        if self.mpdClient is not None:
+            try:
+                self.mpdClient.disconnect()
+            except:
+                pass
+            self.mpdClient = None
+
+
+class Stats(object):
+
+    # Call counts, bytes received and latencies per command, for finding
+    # out where the time goes. Off unless enabled, and then all it costs is
+    # the check of Stats.enabled in Client.cmd.
+
+    # The upper bounds of the latency buckets, in seconds, doubling from a
+    # tenth of a millisecond. One more bucket holds anything slower.
+    BUCKETS = tuple([0.0001 * 2 ** i for i in xrange(18)])
+
+    enabled = False
+    path = None
+    commands = {}
+
+    # Worker threads record too.
+    lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, path):
+        # path is where dump writes the numbers.
+        cls.path = path
+        cls.enabled = True
+
+    @classmethod
+    def record(cls, command, seconds, size):
+        bucket = bisect.bisect_left(cls.BUCKETS, seconds)
+        with cls.lock:
+            if not command in cls.commands:
+                cls.commands[command] = {"calls": 0, "bytes": 0,\
+                "seconds": 0.0, "histogram": [0] * (len(cls.BUCKETS) + 1)}
+            entry = cls.commands[command]
+            entry["calls"] = entry["calls"] + 1
+            entry["bytes"] = entry["bytes"] + size
+            entry["seconds"] = entry["seconds"] + seconds
+            entry["histogram"][bucket] = entry["histogram"][bucket] + 1
+
+    @classmethod
+    def size(cls, result):
+        # The size of a parsed response as it came over the wire, which is
+        # a "key: value" line per value. Bare strings come from commands
+        # like list, whose keys we no longer have.
+        if isinstance(result, dict):
+            size = 0
+            for key, value in result.iteritems():
+                if isinstance(value, list):
+                    for item in value:
+                        size = size + len(key) + len(item) + 3
+                else:
+                    size = size + len(key) + len(value) + 3
+            return size
+        if isinstance(result, list):
+            return sum([cls.size(item) for item in result])
+        if isinstance(result, str):
+            return len(result) + 1
+        return 0
+
+    @classmethod
+    def snapshot(cls):
+        with cls.lock:
+            return dict((command, dict(entry, histogram =\
+            list(entry["histogram"])))\
+            for command, entry in cls.commands.iteritems())
+
+    @classmethod
+    def dump(cls):
+        # Written to a temporary file first, so that a reader never sees
+        # half a dump.
+        if cls.path is None:
+            return
+        data = {"buckets": list(cls.BUCKETS), "commands": cls.snapshot()}
+        try:
+            with open(cls.path + ".part", "w") as dumpFile:
+                json.dump(data, dumpFile, indent = 2, sort_keys = True)
+            os.rename(cls.path + ".part", cls.path)
+        except (IOError, OSError):
+            pass
+
+
+class Recorder(object):
+
+    # Writes a timestamped trace of everything said on our connections to
+    # MPD, for benchmarks/replay.py to serve back later. Each line of the
+    # trace is a JSON list of [seconds, connection, direction, data], where
+    # direction is ">" for what we sent and "<" for what we received. The
+    # data is decoded as Latin-1, so that any bytes at all survive.
+    #
+    # Traces get sent to other people, so the password is never written.
+    # Its command is written with the argument left out.
+
+    PASSWORD = "password "
+
+    enabled = False
+    traceFile = None
+    start = 0
+    connections = 0
+
+    # Every connection writes to the one trace.
+    lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, path):
+        cls.traceFile = open(path, "w")
+        cls.start = time.time()
+        cls.enabled = True
+
+    @classmethod
+    def stop(cls):
+        with cls.lock:
+            cls.enabled = False
+            if cls.traceFile is not None:
+                cls.traceFile.close()
+                cls.traceFile = None
+
+    @classmethod
+    def open(cls):
+        # Returns the number of a new connection.
+        with cls.lock:
+            cls.connections = cls.connections + 1
+            return cls.connections
+
+    @classmethod
+    def write(cls, connection, direction, data):
+        if direction == ">" and data.startswith(Recorder.PASSWORD):
+            data = "password\n"
+        with cls.lock:
+            if cls.traceFile is not None:
+                cls.traceFile.write(json.dumps([\
+                round(time.time() - cls.start, 6), connection, direction,\
+                data.decode("latin-1")]) + "\n")
+
+    @classmethod
+    def wrap(cls, mpdClient):
+        # MPDClient has no hook for this, so we swap out the files it reads
+        # and writes its socket through. It has already read the greeting
+        # by now, so that's written from what it kept of it.
+        connection = cls.open()
+        cls.write(connection, "<", "OK MPD %s\n" % mpdClient.mpd_version)
+        mpdClient._rfile = RecordingFile(mpdClient._rfile, connection)
+        mpdClient._wfile = RecordingFile(mpdClient._wfile, connection)
+
+
+class RecordingFile(object):
+
+    # Stands in for one of an MPDClient's socket files.
+
+    def __init__(self, wrapped, connection):
+        self.wrapped = wrapped
+        self.connection = connection
+
+    def readline(self):
+        line = self.wrapped.readline()
+        Recorder.write(self.connection, "<", line)
+        return line
+
+    def write(self, data):
+        Recorder.write(self.connection, ">", data)
+        self.wrapped.write(data)
+
+    def flush(self):
+        self.wrapped.flush()
+
+    def close(self):
+        self.wrapped.close()
+
+
+class Future(object):
+
+    # What an AsyncClient command returns, once its response has arrived.
+    # Callbacks added after that are called straight away.
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def then(self, callback, errback = None):
+        if self.done:
+            self.call(callback, errback)
+        else:
+            self.callbacks.append((callback, errback))
+        return self
+
+    def call(self, callback, errback):
+        if self.error is None:
+            if callback is not None:
+                callback(self.result)
+        elif errback is not None:
+            errback(self.error)
+
+    def resolve(self, result, error = None):
+        self.done = True
+        self.result = result
+        self.error = error
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback, errback in callbacks:
+            self.call(callback, errback)
+
+
+class AsyncClient(QtCore.QObject):
+
+    # Speaks the MPD protocol without ever waiting on the socket. It's
+    # driven by socket notifiers in the event loop. Commands are written as
+    # soon as they're sent, and any number of them can be in flight at
+    # once. MPD answers in order, so each response goes to the oldest
+    # Future still waiting.
+    #
+    # Call sites move over to it from Client.cmd one at a time, through
+    # Client.send.
+    #
+    # It can go quiet for a long time between commands, so it pings the
+    # server as a Connection would, and if the server hangs up all the same
+    # it connects again on the next send. Only failing to connect again is
+    # reported, as "broken".
+
+    # These answer with one object. Everything else answers with a list.
+    OBJECT_COMMANDS = ("status", "currentsong", "stats")
+
+    # The keys that start a new object in a list.
+    DELIMITERS = ("file", "directory", "playlist")
+
+    # For the TCP connection itself, which is made before the event loop
+    # takes over.
+    TIMEOUT = 10
+
+    def __init__(self, parent = None):
+        super(AsyncClient, self).__init__(parent)
+        self.socket = None
+        self.readNotifier = None
+        self.writeNotifier = None
+        self.incoming = ""
+        self.outgoing = ""
+        self.pairs = []
+        # Of the response being read, for Stats.
+        self.size = 0
+        self.waiting = collections.deque()
+        # The connection's number in the Recorder's trace.
+        self.recording = None
+        # Where to connect again to, until we're closed.
+        self.connection = None
+        self.lastUsed = 0
+        self.pingTimer = QtCore.QTimer(self)
+        self.pingTimer.setInterval(Connection.HEALTH_INTERVAL * 1000)
+        self.connect(self.pingTimer, QtCore.SIGNAL("timeout()"), self.ping)
+
+    def connectToServer(self, connection):
+        # Takes the address and password of a Connection. The greeting and
+        # the password go through the pipeline like any command.
+        # Exceptions are caught in the calling method.
+        self.connection = connection
+        if connection.host.startswith("/"):
+            # The path to a unix socket, as MPDClient takes it.
+            unixSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                unixSocket.settimeout(AsyncClient.TIMEOUT)
+                unixSocket.connect(connection.host)
+            except socket.error:
+                unixSocket.close()
+                raise
+            self.socket = unixSocket
+        else:
+            self.socket = socket.create_connection(\
+            (connection.host, connection.port), AsyncClient.TIMEOUT)
+        self.socket.setblocking(False)
+        self.lastUsed = time.time()
+        self.pingTimer.start()
+        if Recorder.enabled:
+            self.recording = Recorder.open()
+        self.readNotifier = QtCore.QSocketNotifier(self.socket.fileno(),\
+        QtCore.QSocketNotifier.Read, self)
+        self.connect(self.readNotifier, QtCore.SIGNAL("activated(int)"),
+            self.readReady)
+        self.writeNotifier = QtCore.QSocketNotifier(self.socket.fileno(),\
+        QtCore.QSocketNotifier.Write, self)
+        self.writeNotifier.setEnabled(False)
+        self.connect(self.writeNotifier, QtCore.SIGNAL("activated(int)"),
+            self.writeReady)
+        self.waiting.append((Future(), None, time.time()))
+        if connection.password is not None:
+            self.send("password", connection.password)
+
+    def isConnected(self):
+        return self.socket is not None
+
+    def send(self, command, *args):
+        future = Future()
+        if self.socket is None and self.connection is not None:
+            try:
+                self.connectToServer(self.connection)
+            except socket.error as e:
+                self.connection = None
+                future.resolve(None, e)
+                self.emit(QtCore.SIGNAL("broken"), e)
+                return future
+        if self.socket is None:
+            future.resolve(None, MPDError("Not connected"))
+            return future
+        line = command
+        for arg in args:
+            line = line + ' "' + str(arg).replace("\\", "\\\\")\
+            .replace('"', '\\"') + '"'
+        self.outgoing = self.outgoing + line + "\n"
+        if self.recording is not None:
+            Recorder.write(self.recording, ">", line + "\n")
+        self.lastUsed = time.time()
+        self.waiting.append((future, command, self.lastUsed))
+        self.writeNotifier.setEnabled(True)
+        return future
+
+    def ping(self):
+        # Keeps MPD from timing out a connection that has been quiet.
+        if self.socket is not None and\
+        time.time() - self.lastUsed > Connection.HEALTH_INTERVAL:
+            self.send("ping")
+
+    def writeReady(self):
+        try:
+            sent = self.socket.send(self.outgoing)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.fail(e)
+            return
+        self.outgoing = self.outgoing[sent:]
+        if len(self.outgoing) == 0:
+            self.writeNotifier.setEnabled(False)
+
+    def readReady(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.fail(e)
+            return
+        if len(data) == 0:
+            self.fail(socket.error("Connection closed by the server"))
+            return
+        if self.recording is not None:
+            Recorder.write(self.recording, "<", data)
+        lines = (self.incoming + data).split("\n")
+        self.incoming = lines.pop()
+        for line in lines:
+            self.readLine(line)
+            # A callback may have closed us.
+            if self.socket is None:
+                return
+
+    def readLine(self, line):
+        if line == "OK" or line.startswith("OK MPD "):
+            self.finish(None)
+        elif line.startswith("ACK "):
+            self.finish(MPDError(line))
+        else:
+            key, separator, value = line.partition(": ")
+            self.pairs.append((key, value))
+            self.size = self.size + len(line) + 1
+
+    def finish(self, error):
+        future, command, start = self.waiting.popleft()
+        pairs = self.pairs
+        self.pairs = []
+        if Stats.enabled and command is not None:
+            Stats.record(command + " (async)", time.time() - start,\
+            self.size)
+        self.size = 0
+        if error is None:
+            future.resolve(self.parse(command, pairs))
+        else:
+            future.resolve(None, error)
+
+    def parse(self, command, pairs):
+        # Keys are lowercased and repeated keys within an object become
+        # lists, as with MPDClient.
+        objects = []
+        for key, value in pairs:
+            key = key.lower()
+            if len(objects) == 0 or key in AsyncClient.DELIMITERS:
+                objects.append({})
+            item = objects[-1]
+            if not key in item:
+                item[key] = value
+            elif isinstance(item[key], list):
+                item[key].append(value)
             else:
-                valueString = valueString + ", "
-            valueString = valueString + value.strip().decode("utf-8")
-        return valueString
+                item[key] = [item[key], value]
+        if command in AsyncClient.OBJECT_COMMANDS:
+            if len(objects) == 0:
+                return {}
+            return objects[0]
+        return objects
+
+    def fail(self, error):
+        # The socket is dropped, and the next send connects again.
+        self.disconnectSocket(error)
+
+    def close(self, error = None):
+        self.connection = None
+        self.disconnectSocket(error)
+
+    def disconnectSocket(self, error):
+        # Whatever was still waiting fails.
+        if self.socket is None:
+            return
+        self.pingTimer.stop()
+        for notifier in (self.readNotifier, self.writeNotifier):
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+        self.readNotifier = None
+        self.writeNotifier = None
+        try:
+            self.socket.close()
+        except:
+            pass
+        self.socket = None
+        self.incoming = ""
+        self.outgoing = ""
+        self.pairs = []
+        self.size = 0
+        waiting = self.waiting
+        self.waiting = collections.deque()
+        if error is None:
+            error = MPDError("Disconnected")
+        for future, command, start in waiting:
+            future.resolve(None, error)
 
 
 class Client(object):
 
-    client = None
+    # The main thread has the control connection to itself, so that play,
+    # pause and the status never wait behind a big listallinfo. Bulk work
+    # is done on other threads, with worker connections borrowed from a
+    # pool.
+
+    WORKERS = 2
+
+    control = None
+    workers = None
+
+    # Shares the control connection's settings, but not its socket.
+    asyncClient = None
+
+    # Threads with a connection of their own put it in local.client.
+    local = threading.local()
 
     @classmethod
     def create(cls):
-        cls.client = MPDClient()
+        options = Options()
+        cls.control = Connection(options)
+        cls.workers = Queue.Queue()
+        for i in xrange(cls.WORKERS):
+            cls.workers.put(Connection(options))
+
+    @classmethod
+    def connect(cls):
+        # Opens the control connection and the asynchronous one. The workers
+        # connect when they're first borrowed.
+        cls.control.client()
+        cls.asyncClient = AsyncClient()
+        cls.asyncClient.connectToServer(cls.control)
 
     @classmethod
     def delete(cls):
-        cls.client = None
+        if cls.control is not None:
+            cls.control.close()
+        if cls.asyncClient is not None:
+            cls.asyncClient.close()
+        # Connections out on loan are closed when they come back.
+        workers = cls.workers
+        while workers is not None and not workers.empty():
+            workers.get().close()
+        cls.control = None
+        cls.workers = None
+        cls.asyncClient = None
 
     @classmethod
     def exists(cls):
-        return not cls.client is None
+        return not cls.control is None
+
+    @classmethod
+    @contextlib.contextmanager
+    def worker(cls):
+        # Lends the calling thread a worker connection for the duration of
+        # a with block, waiting for one if they're all out.
+        workers = cls.workers
+        if workers is None:
+            raise MPDError("Not connected")
+        connection = workers.get()
+        try:
+            cls.local.client = connection.client()
+            yield
+        except (MPDError, socket.error):
+            connection.close()
+            raise
+        finally:
+            cls.local.client = None
+            if cls.workers is workers:
+                workers.put(connection)
+            else:
+                connection.close()
+
+    @classmethod
+    def connection(cls):
+        client = getattr(cls.local, "client", None)
+        if client is None:
+            return cls.control.client()
+        return client
 
     @classmethod
     def cmd(cls, command, a = None, b = None, c = None):
+        if not Stats.enabled:
+            return cls.call(command, a, b, c)
+        start = time.time()
+        result = cls.call(command, a, b, c)
+        Stats.record(command, time.time() - start, Stats.size(result))
+        return result
+
+    @classmethod
+    def call(cls, command, a = None, b = None, c = None):
+        client = cls.connection()
         if c is not None:
-            return getattr(cls.client, command)(str(a), str(b), str(c))
+            return getattr(client, command)(str(a), str(b), str(c))
         if b is not None:
-            return getattr(cls.client, command)(str(a), str(b))
+            return getattr(client, command)(str(a), str(b))
         if a is not None:
-            return getattr(cls.client, command)(str(a))
-        return getattr(cls.client, command)()
+            return getattr(client, command)(str(a))
+        return getattr(client, command)()
+
+    @classmethod
+    def send(cls, command, *args):
+        # Like cmd, but returns a Future at once instead of waiting.
+        if cls.asyncClient is None:
+            future = Future()
+            future.resolve(None, MPDError("Not connected"))
+            return future
+        return cls.asyncClient.send(command, *args)
+
+    @classmethod
+    def stream(cls, command, a = None):
+        # Like cmd, but the response is parsed lazily, as a generator. It
+        # has to be used up before the connection can take another command.
+        client = cls.connection()
+        client.iterate = True
+        start = time.time()
+        size = 0
+        try:
+            for item in cls.call(command, a):
+                if Stats.enabled:
+                    size = size + Stats.size(item)
+                yield item
+        finally:
+            client.iterate = False
+        if Stats.enabled:
+            Stats.record(command, time.time() - start, size)
+
+    @classmethod
+    def cmdList(cls, commands):
+        # Sends a list of (command, args...) tuples as one command list, so
+        # that they cost one round trip instead of one each. Returns the
+        # result of each command, in order.
+        client = cls.connection()
+        start = time.time()
+        client.command_list_ok_begin()
+        for command in commands:
+            cls.call(*command)
+        results = list(client.command_list_end())
+        if Stats.enabled:
+            Stats.record("command_list", time.time() - start,\
+            Stats.size(results))
+        return results
+
+
+class LibraryCache(object):
+
+    # The parsed library, kept on disk between sessions. A cache belongs to
+    # one server, and is only good for as long as that server's db_update
+    # stays the same. It's written with marshal, which is about as compact
+    # and as quick to read back as anything we have.
+
+    FORMAT = 3
+
+    def __init__(self, host, port):
+        # The host is quoted, since it can be the path to a unix socket.
+        name = "quetzalcoatl/library-%s-%d.cache" %\
+        (urllib.quote(str(host), ""), port)
+        self.path = str(kdecore.KStandardDirs.locateLocal("data", name))
+
+    def header(self, dbUpdate):
+        return (LibraryCache.FORMAT, marshal.version, dbUpdate)
+
+    def read(self, dbUpdate):
+        # Returns None unless there's a cache for this db_update.
+        try:
+            cacheFile = open(self.path, "rb")
+            try:
+                if marshal.load(cacheFile) <> self.header(dbUpdate):
+                    return None
+                return marshal.load(cacheFile)
+            finally:
+                cacheFile.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def write(self, dbUpdate, dumped):
+        # Written to the side and renamed into place, so that a crash can't
+        # leave half a cache behind.
+        try:
+            partial = self.path + ".part"
+            cacheFile = open(partial, "wb")
+            try:
+                marshal.dump(self.header(dbUpdate), cacheFile)
+                marshal.dump(dumped, cacheFile)
+            finally:
+                cacheFile.close()
+            os.rename(partial, self.path)
+        except (IOError, OSError, ValueError):
+            pass
+
+
+class SongTable(object):
+
+    # Songs kept by column rather than as a dict each, for the library,
+    # where there can be hundreds of thousands of them. A song is a row
+    # number.
+    #
+    # Numbers are kept in arrays. A tag column holds one code per row,
+    # standing for a tuple of values that is stored only once, and the
+    # strings in those tuples are interned. An artist's name exists once
+    # however many songs it's on.
+
+    NUMBERS = ("time", "track", "disc", "last-modified")
+
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+    def __init__(self):
+        self.files = []
+        self.titles = []
+        # The title part of the sort key. It isn't cached on disk, since
+        # it's cheap to work out again.
+        self.collations = []
+        self.numbers = dict((key, array.array("l"))\
+        for key in SongTable.NUMBERS)
+        self.tags = dict((tag, array.array("l")) for tag in Parser.TAGS)
+        self.tuples = [()]
+        self.codes = {(): 0}
+        # Midnight of each day seen in a last-modified, in seconds.
+        self.days = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def append(self, record):
+        # Takes a record from Parser.normalize and returns its row.
+        self.files.append(record["file"])
+        self.titles.append(record["title"])
+        self.collations.append(record["sortkey"][2])
+        numbers = self.numbers
+        numbers["time"].append(record["time"])
+        numbers["track"].append(record["track"])
+        numbers["disc"].append(record["disc"])
+        numbers["last-modified"].append(\
+        self.timestamp(record.get("last-modified")))
+        for tag, column in self.tags.iteritems():
+            column.append(self.code(record.get(tag, ())))
+        return len(self.files) - 1
+
+    def code(self, values):
+        if values in self.codes:
+            return self.codes[values]
+        values = tuple([intern(value) for value in values])
+        code = len(self.tuples)
+        self.tuples.append(values)
+        self.codes[values] = code
+        return code
+
+    def timestamp(self, value):
+        # MPD always writes TIME_FORMAT, which is quicker to slice up than
+        # to hand to strptime, and this runs once per song on every load.
+        # Most songs share their day with others, so days are looked up.
+        try:
+            if len(value) <> 20 or value[10] <> "T" or value[19] <> "Z":
+                return 0
+            day = value[0:10]
+            if not day in self.days:
+                self.days[day] = calendar.timegm((int(value[0:4]),\
+                int(value[5:7]), int(value[8:10]), 0, 0, 0))
+            return self.days[day] + int(value[11:13]) * 3600 +\
+            int(value[14:16]) * 60 + int(value[17:19])
+        except (TypeError, ValueError):
+            return 0
+
+    def file(self, row):
+        return self.files[row]
+
+    def title(self, row):
+        return self.titles[row]
+
+    def values(self, row, tag):
+        return self.tuples[self.tags[tag][row]]
+
+    def titleKey(self, row):
+        return self.collations[row]
+
+    def sortKey(self, row):
+        return (self.numbers["disc"][row], self.numbers["track"][row],\
+        self.collations[row])
+
+    def record(self, row):
+        # The row as a record, for code that wants one.
+        record = {"file": self.files[row], "title": self.titles[row],\
+        "sortkey": self.sortKey(row)}
+        for key, column in self.numbers.iteritems():
+            record[key] = column[row]
+        if record["last-modified"] > 0:
+            record["last-modified"] = time.strftime(SongTable.TIME_FORMAT,\
+            time.gmtime(record["last-modified"]))
+        else:
+            del record["last-modified"]
+        for tag in Parser.TAGS:
+            values = self.values(row, tag)
+            if len(values) > 0:
+                record[tag] = values
+        return record
+
+    def dump(self):
+        # Plain lists, tuples and strings, for marshal.
+        return (self.files, self.titles,\
+        dict((key, column.tostring())\
+        for key, column in self.numbers.iteritems()),\
+        dict((tag, column.tostring())\
+        for tag, column in self.tags.iteritems()),\
+        self.tuples)
+
+    @classmethod
+    def restore(cls, dumped):
+        table = cls()
+        files, titles, numbers, tags, tuples = dumped
+        table.files = files
+        table.titles = titles
+        table.collations = [title.lower() for title in titles]
+        for key, column in table.numbers.iteritems():
+            column.fromstring(numbers[key])
+        for tag, column in table.tags.iteritems():
+            column.fromstring(tags[tag])
+        table.tuples = [tuple([intern(value) for value in values])\
+        for values in tuples]
+        table.codes = dict((values, code)\
+        for code, values in enumerate(table.tuples))
+        return table
+
+
+class Library(object):
+
+    # The whole database, fetched with a single listallinfo into a
+    # SongTable and indexed in memory, so that browsing never has to go
+    # back to the server.
+    #
+    # There is one tree per path. A tree maps a tag value to an entry of
+    # (rows, subtree), where the subtree is keyed on the next tag along the
+    # path. Songs with several values for a tag are filed under each one.
+    #
+    # All of it is held in one snapshot of (table, trees, files, chunks),
+    # which a "database" event can drop at any time. Lookups are made on
+    # the snapshot that ensure returned, never on the class.
+
+    PATHS = (("genre", "artist", "album"), ("artist", "album"),\
+    ("composer", "album"), ("album",))
+
+    # Songs are sorted by title a chunk at a time, and the whole library in
+    # title order is a merge of the chunks.
+    CHUNK_SIZE = 4096
+
+    snapshot = None
+    cache = None
+
+    # The library is loaded by whichever thread needs it first.
+    lock = threading.Lock()
+
+    @classmethod
+    def clear(cls):
+        cls.snapshot = None
+
+    @classmethod
+    def restore(cls, host, port):
+        # Called on connecting. If the server's database hasn't changed
+        # since we last cached it, we start out with the cached copy.
+        # Exceptions are caught in the calling method.
+        cls.clear()
+        cls.cache = LibraryCache(host, port)
+        dumped = cls.cache.read(Client.cmd("stats")["db_update"])
+        if dumped is not None:
+            cls.index(SongTable.restore(dumped))
+
+    @classmethod
+    def load(cls):
+        # Exceptions are caught in the calling method.
+        dbUpdate = Client.cmd("stats")["db_update"]
+        table = SongTable()
+        for song in Client.stream("listallinfo"):
+            if Parser.isValid(song):
+                table.append(Parser.normalize(song))
+        cls.index(table)
+        if cls.cache is not None:
+            cls.cache.write(dbUpdate, table.dump())
+
+    @classmethod
+    def index(cls, table):
+        files = {}
+        trees = dict((path[0], {}) for path in cls.PATHS)
+        for row in xrange(len(table)):
+            files[table.file(row)] = row
+            for path in cls.PATHS:
+                cls.file(table, trees[path[0]], path, row)
+        chunks = []
+        for first in xrange(0, len(table), cls.CHUNK_SIZE):
+            chunk = range(first, min(first + cls.CHUNK_SIZE, len(table)))
+            chunk.sort(key = table.titleKey)
+            chunks.append(array.array("l", chunk))
+        cls.snapshot = (table, trees, files, chunks)
+
+    @classmethod
+    def file(cls, table, tree, path, row):
+        for value in table.values(row, path[0]):
+            if not value in tree:
+                tree[value] = (array.array("l"), {})
+            entry = tree[value]
+            entry[0].append(row)
+            if len(path) > 1:
+                cls.file(table, entry[1], path[1:], row)
+
+    @classmethod
+    def ensure(cls):
+        # Returns the snapshot, loading it first if need be.
+        with cls.lock:
+            snapshot = cls.snapshot
+            if snapshot is None:
+                cls.load()
+                snapshot = cls.snapshot
+            return snapshot
+
+    @classmethod
+    def entry(cls, snapshot, filters):
+        # Follows (tag, value) filters down one of the paths.
+        table, trees, files, chunks = snapshot
+        empty = ((), {})
+        tag, value = filters[0]
+        entry = trees[tag].get(value, empty)
+        for tag, value in filters[1:]:
+            entry = entry[1].get(value, empty)
+        return entry
+
+    @classmethod
+    def row(cls, snapshot, uri):
+        table, trees, files, chunks = snapshot
+        return files.get(uri)
+
+    @classmethod
+    def titleOrder(cls, snapshot):
+        # Every row, by title, as a generator.
+        table, trees, files, chunks = snapshot
+        chunks = [cls.decorate(table, chunk) for chunk in chunks]
+        for key, row in heapq.merge(*chunks):
+            yield row
+
+    @classmethod
+    def decorate(cls, table, chunk):
+        for row in chunk:
+            yield (table.titleKey(row), row)
+
+    @classmethod
+    def songs(cls, snapshot, *filters):
+        # The rows matching all the filters, or every row without any.
+        # Callers mustn't change what they get.
+        if len(filters) == 0:
+            return xrange(len(snapshot[0]))
+        return cls.entry(snapshot, filters)[0]
+
+    @classmethod
+    def values(cls, snapshot, tag, *filters):
+        # The values of tag among the songs matching the filters. The tag
+        # has to be the one that follows the filters along a path.
+        if len(filters) == 0:
+            return snapshot[1][tag].keys()
+        return cls.entry(snapshot, filters)[1].keys()
+
+
+class StoredPlaylists(object):
+
+    # The server's stored playlists, by name, with their last-modified. The
+    # connector keeps this current from listplaylists, on connecting and on
+    # every stored_playlist idle event. A playlist's songs are cached the
+    # first time they're fetched, and are good for as long as its
+    # last-modified stays the same.
+
+    playlists = {}
+
+    # Name to (last-modified, SongTable).
+    contents = {}
+
+    # Fetch threads read and fill the contents.
+    lock = threading.Lock()
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.playlists = {}
+            cls.contents = {}
+
+    @classmethod
+    def update(cls, playlists):
+        # Takes what listplaylists returns. Contents that are out of date
+        # are dropped.
+        with cls.lock:
+            cls.playlists = dict((playlist["playlist"],\
+            playlist["last-modified"]) for playlist in playlists)
+            for name, (modified, table) in cls.contents.items():
+                if cls.playlists.get(name) <> modified:
+                    del cls.contents[name]
+
+    @classmethod
+    def exists(cls, name):
+        return name in cls.playlists
+
+    @classmethod
+    def songs(cls, name):
+        # Returns a SongTable of the playlist's songs, in order, fetching
+        # them if they aren't cached. Exceptions are caught in the calling
+        # method.
+        with cls.lock:
+            modified = cls.playlists.get(name)
+            cached = cls.contents.get(name)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+        table = SongTable()
+        for song in Client.cmd("listplaylistinfo", name):
+            table.append(Parser.normalize(song))
+        with cls.lock:
+            if modified is not None and cls.playlists.get(name) == modified:
+                cls.contents[name] = (modified, table)
+        return table
 
 
 class IdleThread(QtCore.QThread):
 
+    # The subsystems whose changes show up in the status.
+    STATUS_SUBSYSTEMS = ("player", "playlist", "options", "mixer")
+
     def __init__(self, parent = None):
         super(IdleThread, self).__init__(parent)
         self.mpdClient = None
@@ -173,11 +1207,18 @@ class IdleThread(QtCore.QThread):
 
     def run(self):
         while (Client.exists()):
-            playlists = None
             try:
-                self.mpdClient.idle("stored_playlist")
-                self.emit(QtCore.SIGNAL("playlists"),
-                    self.mpdClient.listplaylists())
+                changes = self.mpdClient.idle("stored_playlist",\
+                "database", *IdleThread.STATUS_SUBSYSTEMS)
+                if "stored_playlist" in changes:
+                    self.emit(QtCore.SIGNAL("playlists"),
+                        self.mpdClient.listplaylists())
+                if "database" in changes:
+                    self.emit(QtCore.SIGNAL("database"))
+                for subsystem in IdleThread.STATUS_SUBSYSTEMS:
+                    if subsystem in changes:
+                        self.emit(QtCore.SIGNAL("status"), changes)
+                        break
             except:
                 pass
 
@@ -191,14 +1232,15 @@ class Idler(QtCore.QObject):
         self.idleThread = None
 
     def start(self):
-        self.idleClient = MPDClient()
-        self.idleClient.connect(str(self.options.host), self.options.port)
+        self.idleClient = Connection(self.options).client()
         self.idleThread = IdleThread()
-        if self.options.needPassword:
-            self.idleClient.password(str(self.options.password))
         self.idleThread.client = self.idleClient
         self.connect(self.idleThread, QtCore.SIGNAL("playlists"),
             self.setPlaylistsChanged)
+        self.connect(self.idleThread, QtCore.SIGNAL("status"),
+            self.setStatusChanged)
+        self.connect(self.idleThread, QtCore.SIGNAL("database"),
+            self.setDatabaseChanged)
         self.idleThread.start()
 
     def stop(self):
@@ -212,10 +1254,52 @@ class Idler(QtCore.QObject):
         sortedList = sorted(playlists, key = self.sortingKey)
         self.emit(QtCore.SIGNAL("playlists"), sortedList)
 
+    def setStatusChanged(self, subsystems):
+        self.emit(QtCore.SIGNAL("status"), subsystems)
+
+    def setDatabaseChanged(self):
+        self.emit(QtCore.SIGNAL("database"))
+
     def sortingKey(self, element):
         return element["playlist"].strip().lower()
 
 
+class FetchThread(QtCore.QThread):
+
+    # Runs the DatabaseModels' fetches, so that a slow one doesn't freeze
+    # the window. It borrows a worker connection for each fetch, and hands
+    # the fetched nodes back through queued signals.
+
+    def __init__(self, parent = None):
+        super(FetchThread, self).__init__(parent)
+        self.requests = Queue.Queue()
+
+    def request(self, model, node, token):
+        self.requests.put((model, node, token))
+
+    def stop(self):
+        self.requests.put(None)
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            model, node, token = request
+            try:
+                with Client.worker():
+                    node.preFetch()
+                self.emit(QtCore.SIGNAL("fetched"), model, node, token)
+            except (MPDError, socket.error) as e:
+                self.emit(QtCore.SIGNAL("failed"), model, e)
+            except Exception:
+                # A bug in a fetcher, which says nothing about the
+                # connection. It's reported against the node, and the
+                # thread goes on serving the requests routed to it.
+                self.emit(QtCore.SIGNAL("error"), model, node, token,\
+                traceback.format_exc())
+
+
 class Options(object):
 
     def __init__(self):
@@ -266,9 +1350,30 @@ class Connector(QtCore.QObject):
     def __init__(self, parent):
         super(Connector, self).__init__(parent)
         self.connectables = []
+
+        # The status is only fetched when the idler says it changed. In
+        # between, the timer just moves the elapsed time along.
         self.timer = QtCore.QTimer()
-        self.connect(self.timer, QtCore.SIGNAL("timeout()"), self.update)
+        self.connect(self.timer, QtCore.SIGNAL("timeout()"), self.tick)
         self.idler = Idler()
+        self.connect(self.idler, QtCore.SIGNAL("status"), self.update)
+
+        # The library is reloaded on the next expansion after it changes.
+        self.connect(self.idler, QtCore.SIGNAL("database"), Library.clear)
+        self.status = None
+        self.statusTime = 0
+
+        # One fetch thread per worker connection. Each model's fetches all
+        # go to the same one, so that a node is only fetched by one thread
+        # at a time. The first thread is kept for the stored playlists,
+        # which don't need the library, so that they can be browsed while
+        # it loads. The library tabs share the others.
+        self.fetchThreads = []
+        self.fetchRoutes = {}
+        # Threads that were stopped, until they've finished their last
+        # fetch. A QThread mustn't be destroyed while it runs.
+        self.stoppedThreads = []
+
         self.updateables = []
         self.options = Options()
 
@@ -282,9 +1387,8 @@ class Connector(QtCore.QObject):
         Client.create()
         connected = False
         try:
-            Client.cmd("connect", self.options.host, self.options.port)
-            if self.options.needPassword:
-                Client.cmd("password", self.options.password)
+            Client.connect()
+            Library.restore(self.options.host, self.options.port)
             connected = True
         except (MPDError, socket.error) as e:
             Client.delete()
@@ -292,21 +1396,68 @@ class Connector(QtCore.QObject):
             "Cannot connect to MPD", str(e), "Cannot Connect")
 
         if connected:
+            self.connect(Client.asyncClient, QtCore.SIGNAL("broken"),
+                self.setAsyncBroken)
             for connectable in self.connectables:
                 connectable.clientConnect()
             self.update()
             self.updatePlaylists()
             self.timer.start(Connector.SECOND)
             self.idler.start()
-
-    def update(self):
+            for i in xrange(Client.WORKERS):
+                fetchThread = FetchThread()
+                self.connect(fetchThread, QtCore.SIGNAL("fetched"),
+                    self.setFetched)
+                self.connect(fetchThread, QtCore.SIGNAL("failed"),
+                    self.setFetchFailed)
+                self.connect(fetchThread, QtCore.SIGNAL("error"),
+                    self.setFetchError)
+                self.connect(fetchThread, QtCore.SIGNAL("finished()"),
+                    self.releaseFetchThread)
+                fetchThread.start()
+                self.fetchThreads.append(fetchThread)
+
+    def update(self, subsystems = None):
+        # Everything a refresh needs goes in one command list: the status,
+        # the current song and, unless we know the queue hasn't changed,
+        # the queue's changes since the version in the last status. The
+        # updateables get the lot.
         try:
-            for updateable in self.updateables:
-                if Client.exists():
-                    updateable.update(Client.cmd("status"))
+            if Client.exists():
+                commands = [("status",), ("currentsong",)]
+                changes = None
+                if subsystems is None or "playlist" in subsystems or\
+                self.status is None:
+                    version = PlaylistModel.NO_VERSION
+                    if self.status is not None:
+                        version = int(self.status["playlist"])
+                    commands.append(("plchangesposid", version))
+                results = Client.cmdList(commands)
+                if len(results) > 2:
+                    changes = (version, results[2])
+                self.status = results[0]
+                self.statusTime = time.time()
+                for updateable in self.updateables:
+                    updateable.update(self.status, results[1], changes)
         except (MPDError, socket.error) as e:
             self.setBroken(e)
 
+    def tick(self):
+        # Interpolates the elapsed time from the last status we fetched.
+        if self.status is None or not "time" in self.status:
+            return
+        if self.status["state"] <> "play":
+            return
+        total = Parser.total(self.status)
+        elapsed = Parser.elapsed(self.status) +\
+        int(time.time() - self.statusTime)
+        if total > 0:
+            elapsed = min(elapsed, total)
+        status = dict(self.status)
+        status["time"] = str(elapsed) + ":" + str(total)
+        for updateable in self.updateables:
+            updateable.update(status)
+
     def setBroken(self, e):
         self.disconnectFromClient()
         kdeui.KMessageBox.detailedError(self.parent(),\
@@ -314,15 +1465,58 @@ class Connector(QtCore.QObject):
 
     def disconnectFromClient(self):
         self.timer.stop()
+        self.status = None
         for connectable in self.connectables:
             connectable.clientDisconnect()
         self.playlistModel.clientDisconnect()
-        try:
-            Client.cmd("disconnect")
-        except:
-            pass
         Client.delete()
+        Library.clear()
+        StoredPlaylists.clear()
         self.idler.stop()
+        for fetchThread in self.fetchThreads:
+            fetchThread.stop()
+        self.stoppedThreads.extend(self.fetchThreads)
+        self.fetchThreads = []
+        self.fetchRoutes = {}
+
+    def releaseFetchThread(self):
+        # finished() is emitted just before the thread ends, so it's waited
+        # for, which is at most a moment.
+        fetchThread = self.sender()
+        fetchThread.wait()
+        if fetchThread in self.stoppedThreads:
+            self.stoppedThreads.remove(fetchThread)
+
+    def setAsyncBroken(self, e):
+        if Client.exists():
+            self.setBroken(e)
+
+    def fetch(self, model, node, token):
+        if len(self.fetchThreads) == 0:
+            return
+        if not model in self.fetchRoutes:
+            if model is self.playlistModel or len(self.fetchThreads) == 1:
+                self.fetchRoutes[model] = self.fetchThreads[0]
+            else:
+                shared = self.fetchThreads[1:]
+                routed = len([route for route in self.fetchRoutes.values()\
+                if route is not self.fetchThreads[0]])
+                self.fetchRoutes[model] = shared[routed % len(shared)]
+        self.fetchRoutes[model].request(model, node, token)
+
+    def setFetched(self, model, node, token):
+        model.insertFetched(node, token)
+
+    def setFetchFailed(self, model, e):
+        if Client.exists():
+            model.emit(QtCore.SIGNAL("broken"), str(e))
+            self.setBroken(e)
+
+    def setFetchError(self, model, node, token, details):
+        if model.fetchFailed(node, token):
+            kdeui.KMessageBox.detailedError(self.parent(),\
+            "Cannot load " + unicode(node.data().toString()), details,\
+            "Cannot Load")
 
     def addConnectable(self, connectable, updateable = False):
         connectable.setConnector(self)
@@ -335,15 +1529,20 @@ class Connector(QtCore.QObject):
             if Client.exists():
                 playlists = Client.cmd("listplaylists")
                 sortedPlaylists = sorted(playlists, key = self.sortingKey)
-                self.playlistModel.setPlaylists(sortedPlaylists)
+                self.setPlaylists(sortedPlaylists)
         except (MPDError, socket.error) as e:
             self.setBroken(e)
 
+    def setPlaylists(self, playlists):
+        # The registry first, so that nodes fetched again see its changes.
+        StoredPlaylists.update(playlists)
+        self.playlistModel.setPlaylists(playlists)
+
     def addPlaylistModel(self, model):
         model.setConnector(self)
         self.playlistModel = model
         self.connect(self.idler, QtCore.SIGNAL("playlists"),
-        self.playlistModel.setPlaylists)
+        self.setPlaylists)
 
     def sortingKey(self, element):
         return element["playlist"].strip().lower()
@@ -473,12 +1672,20 @@ class Configurer(kdeui.KDialog):
 
 class Node(object):
 
+    # There can be a great many nodes, so they don't get a __dict__.
+    __slots__ = ("nodeParent", "children", "isALeaf", "fetched", "position")
+
     def __init__(self, parent = None):
         self.nodeParent = parent
         self.children = []
         self.isALeaf = False
         self.fetched = True
 
+        # Our row under our parent, kept up to date by whoever changes the
+        # parent's children, so that Qt's many calls to parent() don't each
+        # have to search for it.
+        self.position = 0
+
     def childCount(self):
         return len(self.children)
 
@@ -494,6 +1701,12 @@ class Node(object):
     def isLeaf(self):
         return self.isALeaf
 
+    def isLoading(self):
+        return False
+
+    def hasPending(self):
+        return False
+
     def setParent(self, parent):
         self.nodeParent = parent
 
@@ -501,13 +1714,33 @@ class Node(object):
         return self.nodeParent
 
     def row(self):
-        return self.nodeParent.children.index(self)
+        return self.position
 
     def __getitem__(self, i):
         return self.children[i]
 
     def setChildren(self, children):
         self.children = children
+        self.renumber(0)
+
+    def appendChildren(self, children):
+        first = len(self.children)
+        self.children.extend(children)
+        self.renumber(first)
+
+    def insertChildren(self, row, children):
+        self.children[row:row] = children
+        self.renumber(row)
+
+    def deleteChildren(self, start, end):
+        del self.children[start:end]
+        self.renumber(start)
+
+    def renumber(self, first):
+        # Brings the positions of the children from first on up to date.
+        children = self.children
+        for i in xrange(first, len(children)):
+            children[i].position = i
 
     def clear(self):
         del self.children[:]
@@ -546,21 +1779,73 @@ class Node(object):
 
 class FetchingNode(Node):
 
-    def __init__(self, fetcher, data = None, parent = None):
+    __slots__ = ("fetcher", "query", "preFetched", "prePending", "pending",\
+    "nodeData", "token", "display")
+
+    # When a fetcher streams its nodes, they're created and inserted this
+    # many at a time.
+    PAGE_SIZE = 500
+
+    def __init__(self, fetcher, data = None, parent = None, query = ()):
         super(FetchingNode, self).__init__(parent)
-        fetcher.setNode(self)
         self.fetcher = fetcher
+        self.query = query
         self.preFetched = []
+        self.prePending = None
+        self.pending = None
         self.nodeData = data
+        self.token = 0
+        # Decoded once, rather than every time the node is painted.
+        self.display = self.label()
+
+    def startFetch(self):
+        # Every fetch gets a new token. Results that come back with any
+        # other token are stale.
+        self.setFetched(True)
+        self.pending = None
+        self.token = self.token + 1
+        return self.token
 
     def preFetch(self):
-        self.fetcher.preFetch()
+        self.preFetched = []
+        self.prePending = None
+        self.fetcher.preFetch(self)
+
+    def stream(self, nodes):
+        # For fetchers with too many nodes to create at once. Only the first
+        # page is created now. The rest wait in pending for fetchPage.
+        nodes = iter(nodes)
+        self.preFetched.extend(itertools.islice(nodes,\
+        FetchingNode.PAGE_SIZE))
+        if len(self.preFetched) == FetchingNode.PAGE_SIZE:
+            self.prePending = nodes
+
+    def fetchPage(self):
+        self.preFetched = []
+        self.prePending = None
+        self.stream(self.pending)
+
+    def hasPending(self):
+        return self.pending is not None
 
     def insertCount(self):
         return len(self.preFetched)
 
     def postFetch(self):
-        self.setChildren(self.preFetched)
+        self.appendChildren(self.preFetched)
+        self.preFetched = []
+        self.pending = self.prePending
+        self.prePending = None
+
+    def uris(self):
+        # The pending nodes count too. Since we can't look at them without
+        # creating them, we create them now and keep them for later.
+        uris = super(FetchingNode, self).uris()
+        if self.pending is not None:
+            rest = list(self.pending)
+            self.pending = iter(rest)
+            uris.extend(node.myUri() for node in rest)
+        return uris
 
     def addNode(self, node):
         self.preFetched.append(node)
@@ -571,8 +1856,13 @@ class FetchingNode(Node):
     def clientDisconnect(self):
         self.clear()
         self.setFetched(True)
+        self.pending = None
+        self.token = self.token + 1
 
     def data(self):
+        return self.display
+
+    def label(self):
         if self.nodeData:
             return QtCore.QVariant(self.nodeData.decode("utf-8"))
         return QtCore.QVariant()
@@ -589,454 +1879,169 @@ class FetchingNode(Node):
 
     def setPlaylist(self, name):
         self.nodeData["playlist"] = name
+        self.display = self.label()
 
 
 class SongNode(Node):
 
-    def __init__(self, song, parent = None):
+    # A row of a SongTable.
+
+    __slots__ = ("table", "tableRow", "display")
+
+    def __init__(self, table, row, parent = None):
         super(SongNode, self).__init__(parent)
-        self.song = song
+        self.table = table
+        self.tableRow = row
+        # Made the first time the node is painted. Most nodes never are.
+        self.display = None
         self.setLeaf(True)
 
     def data(self):
-        stripped = Parser.title(self.song).strip()
-        return QtCore.QVariant(stripped.decode("utf-8"))
+        if self.display is None:
+            self.display = QtCore.QVariant(self.table.title(self.tableRow))
+        return self.display
 
     def myUri(self):
-        return self.song["file"]
+        return self.table.file(self.tableRow)
 
     # For the tooltips
     def value(self, key):
         # We assume that the song contains the key.
-        return Parser.parsedValue(self.song, key)
+        return Parser.joinValues(self.table.values(self.tableRow, key))
 
     # Again, for the tooltips
     def hasKey(self, key):
-        return Parser.hasKey(self.song, key)
-
-
-class PlaylistNode(FetchingNode):
-
-    def __init__(self, playlist, parent = None):
-        fetcher = PlaylistSongsFetcher(playlist["playlist"])
-        fetcher.setNode(self)
-        super(PlaylistNode, self).__init__(fetcher, playlist, parent)
-        self.setFetched(False)
-
-    def data(self):
-        return QtCore.QVariant(self.playlist().decode("utf-8"))
+        return len(self.table.values(self.tableRow, key)) > 0
 
 
-class Fetcher(QtCore.QObject):
+class LoadingNode(Node):
 
-    def __init__(self):
-        super(Fetcher, self).__init__()
-        self.myNode = None
+    # Stands in for a node's children while they're being fetched.
 
-    def setNode(self, node):
-        self.myNode = node
+    __slots__ = ()
 
-    def addNode(self, node):
-        self.myNode.addNode(node)
+    LABEL = QtCore.QVariant("Loading...")
 
-    def preFetch(self):
-        raise NotImplementedError
-
-    def node(self):
-        return self.myNode
+    def __init__(self, parent = None):
+        super(LoadingNode, self).__init__(parent)
+        self.setLeaf(True)
 
+    def isLoading(self):
+        return True
 
-class MenuFetcher(Fetcher):
+    def data(self):
+        return LoadingNode.LABEL
 
-    def __init__(self):
-        super(MenuFetcher, self).__init__()
+    def hasKey(self, key):
+        return False
 
-    def preFetch(self):
-        for item in sorted(self.list(), key = str.lower):
-            self.addNode(self.createNode(item))
 
-    def list(self):
-        raise NotImplementedError
+class PlaylistNode(FetchingNode):
 
-    def createNode(self, data):
-        raise NotImplementedError
+    __slots__ = ()
 
+    def __init__(self, playlist, parent = None):
+        super(PlaylistNode, self).__init__(PLAYLIST_SONGS, playlist, parent)
+        self.setFetched(False)
 
-class ListFetcher(Fetcher):
+    def label(self):
+        return QtCore.QVariant(self.playlist().decode("utf-8"))
 
-    def __init__(self, type):
-        super(ListFetcher, self).__init__()
-        self.type = type
 
-    def preFetch(self):
-        for item in sorted(self.list(self.type), key = str.lower):
-            self.addNode(self.createNode(item))
+class Fetcher(object):
 
-    def list(self, type):
-        tags = []
-        for tag in Client.cmd("list", type):
-            if len(tag.strip()) > 0:
-                tags.append(tag)
-        return tags
+    # Fetchers hold no state of their own, and one of each kind is shared
+    # by every node that uses it. What a node fetches is set by its query,
+    # a tuple of (tag, value) filters such as
+    # (("genre", "Jazz"), ("artist", "Miles Davis")).
 
-    def createNode(self, data):
+    def preFetch(self, node):
         raise NotImplementedError
 
 
-class GenresFetcher(ListFetcher):
+class TagsFetcher(Fetcher):
 
-    def __init__(self):
-        super(GenresFetcher, self).__init__("genre")
-
-    def preFetch(self):
-        node = FetchingNode(ArtistsFetcher(), "All Artists", self.node())
-        node.setFetched(False)
-        self.addNode(node)
-
-        super(GenresFetcher, self).preFetch()
-
-    def createNode(self, data):
-        fetcher = GenreArtistsFetcher(data)
-        node = FetchingNode(fetcher, data, self.node())
-        node.setFetched(False)
-        return node
+    # Lists the values of a tag among the songs matching the node's query,
+    # under a first node that lists everything matching it.
 
+    def __init__(self, tag, allLabel, allFetcher, valueFetcher):
+        super(TagsFetcher, self).__init__()
+        self.tag = tag
+        self.allLabel = allLabel
+        self.allFetcher = allFetcher
+        self.valueFetcher = valueFetcher
 
-class GenreArtistsFetcher(MenuFetcher):
+    def preFetch(self, node):
+        node.addNode(self.createNode(self.allFetcher, self.allLabel,\
+        node.query, node))
+        values = Library.values(Library.ensure(), self.tag, *node.query)
+        for value in sorted(values, key = str.lower):
+            query = node.query + ((self.tag, value),)
+            node.addNode(self.createNode(self.valueFetcher, value, query,\
+            node))
 
-    def __init__(self, genre):
-        super(GenreArtistsFetcher, self).__init__()
-        self.genre = genre
-
-    def preFetch(self):
-        node = FetchingNode(GenreSongsFetcher(self.genre), "All", self.node())
-        node.setFetched(False)
-        self.addNode(node)
-        super(GenreArtistsFetcher, self).preFetch()
-
-    def list(self):
-        artists = set()
-        for song in Client.cmd("find", "genre", self.genre):
-            artists = artists | Parser.valueList(song, "artist")
-        return artists
-
-    def createNode(self, data):
-        fetcher = GenreArtistAlbumsFetcher(self.genre, data)
-        node = FetchingNode(fetcher, data, self.node())
-        node.setFetched(False)
-        return node
-
-
-class GenreArtistAlbumsFetcher(MenuFetcher):
-
-    def __init__(self, genre, artist):
-        super(GenreArtistAlbumsFetcher, self).__init__()
-        self.genre = genre
-        self.artist = artist
-
-    def preFetch(self):
-        songsFetcher = GenreArtistSongsFetcher(self.genre, self.artist)
-        node = FetchingNode(songsFetcher, "All Songs", self.node())
-        node.setFetched(False)
-        self.addNode(node)
-        super(GenreArtistAlbumsFetcher, self).preFetch()
-
-    def list(self):
-        albums = set()
-        for song in Client.cmd("find", "genre", self.genre):
-            if Parser.match(song, "artist", self.artist):
-                albums = albums | Parser.valueList(song, "album")
-        return albums
-
-    def createNode(self, data):
-        fetcher = GenreArtistAlbumSongsFetcher(self.genre, self.artist, data)
-        node = FetchingNode(fetcher, data, self.node())
+    def createNode(self, fetcher, data, query, parent):
+        node = FetchingNode(fetcher, data, parent, query)
         node.setFetched(False)
         return node
 
 
 class SongsFetcher(Fetcher):
 
-    def __init__(self, client = None):
-        super(SongsFetcher, self).__init__()
+    # Songs from the library, as rows of its table.
 
-    def cmp(self, a, b):
-        return cmp(Parser.title(a).lower(), Parser.title(b).lower())
+    def preFetch(self, node):
+        snapshot = Library.ensure()
+        table = snapshot[0]
+        node.stream(SongNode(table, row, node)\
+        for row in self.sortedSongs(snapshot, node.query))
 
-    def createNode(self, song):
-        return SongNode(song, self.node())
+    def key(self, table):
+        return table.titleKey
 
-    def songs(self):
-        raise NotImplementedError
+    def sortedSongs(self, snapshot, query):
+        return sorted(Library.songs(snapshot, *query),\
+        key = self.key(snapshot[0]))
 
 
 class AllSongsFetcher(SongsFetcher):
 
-    def __init__(self):
-        super(AllSongsFetcher, self).__init__()
-
-    def preFetch(self):
-        songList = self.songs()
-        songList.sort(self.cmp)
-        for song in songList:
-            self.addNode(self.createNode(song))
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("listallinfo"):
-            if Parser.isValid(song):
-                songList.append(song)
-        return songList
-
-
-class AlbumFetcher(AllSongsFetcher):
-
-    def __init__(self):
-        super(AlbumFetcher, self).__init__()
-
-    def cmp(self, a, b):
-
-        trackOfA = Parser.track(a)
-        trackOfB = Parser.track(b)
-
-        if trackOfA <> trackOfB:
-            return cmp(trackOfA, trackOfB)
-
-        return super(AlbumFetcher, self).cmp(a, b)
-
-
-class GenreArtistAlbumSongsFetcher(AlbumFetcher):
-
-    def __init__(self, genre, artist, album):
-        super(GenreArtistAlbumSongsFetcher, self).__init__()
-        self.genre = genre
-        self.artist = artist
-        self.album = album
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "genre", self.genre):
-            if Parser.match(song, "artist", self.artist):
-                if Parser.match(song, "album", self.album):
-                    songList.append(song)
-        return songList
-
-
-class ArtistsFetcher(ListFetcher):
-
-    def __init__(self):
-        super(ArtistsFetcher, self).__init__("artist")
-
-    def preFetch(self):
-        node = FetchingNode(AlbumsFetcher(), "All Albums", self.node())
-        node.setFetched(False)
-        self.addNode(node)
-        super(ArtistsFetcher, self).preFetch()
-
-    def createNode(self, data):
-        fetcher = ArtistAlbumsFetcher(data)
-        node = FetchingNode(fetcher, data, self.node())
-        node.setFetched(False)
-        return node
-
-
-class AlbumsFetcher(ListFetcher):
-
-    def __init__(self):
-        super(AlbumsFetcher, self).__init__("album")
-
-    def preFetch(self):
-        node = FetchingNode(AllSongsFetcher(), "All Songs", self.node())
-        node.setFetched(False)
-        self.addNode(node)
-        super(AlbumsFetcher, self).preFetch()
-
-    def createNode(self, data):
-        node = FetchingNode(AlbumSongsFetcher(data), data, self.node())
-        node.setFetched(False)
-        return node
-
-
-class AlbumSongsFetcher(AlbumFetcher):
-
-    def __init__(self, album):
-        super(AlbumSongsFetcher, self).__init__()
-        self.album = album
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "album", self.album):
-            if Parser.isValid(song):
-                songList.append(song)
-        return songList
-
-
-class ArtistAlbumsFetcher(MenuFetcher):
-
-    def __init__(self, artist):
-        super(ArtistAlbumsFetcher, self).__init__()
-        self.artist = artist
-
-    def preFetch(self):
-        node = FetchingNode(ArtistSongsFetcher(self.artist), "All Songs",\
-        self.node())
-        node.setFetched(False)
-        self.addNode(node)
-        super(ArtistAlbumsFetcher, self).preFetch()
-
-    def list(self):
-        albums = []
-        for album in Client.cmd("list", "album", self.artist):
-            if len(album.strip()) > 0:
-                albums.append(album)
-        return albums
-
-    def createNode(self, data):
-        fetcher = ArtistAlbumSongsFetcher(self.artist, data)
-        node = FetchingNode(fetcher, data, self.node())
-        node.setFetched(False)
-        return node
-
-
-class ArtistAlbumSongsFetcher(AlbumFetcher):
-
-    def __init__(self, artist, album):
-        super(ArtistAlbumSongsFetcher, self).__init__()
-        self.artist = artist
-        self.album = album
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "artist", self.artist):
-            if Parser.match(song, "album", self.album):
-                songList.append(song)
-        return songList
-
-
-class ComposersFetcher(ListFetcher):
-
-    def __init__(self):
-        super(ComposersFetcher, self).__init__("composer")
-
-    def preFetch(self):
-        node = FetchingNode(AlbumsFetcher(), "All Albums", self.node())
-        node.setFetched(False)
-        self.addNode(node)
-        super(ComposersFetcher, self).preFetch()
-
-    def createNode(self, data):
-        node = FetchingNode(ComposerAlbumsFetcher(data), data, self.node())
-        node.setFetched(False)
-        return node
-
-
-class ComposerAlbumsFetcher(MenuFetcher):
-
-    def __init__(self, composer):
-        super(ComposerAlbumsFetcher, self).__init__()
-        self.composer = composer
-
-    def preFetch(self):
-        node = FetchingNode(ComposerSongsFetcher(self.composer), "All Songs",\
-        self.node())
-        node.setFetched(False)
-        self.addNode(node)
-        super(ComposerAlbumsFetcher, self).preFetch()
-
-    def list(self):
-        albums = set()
-        for song in Client.cmd("find", "composer", self.composer):
-            albums = albums | Parser.valueList(song, "album")
-        return albums
-
-    def createNode(self, data):
-        fetcher = ComposerAlbumSongsFetcher(self.composer, data)
-        node = FetchingNode(fetcher, data, self.node())
-        node.setFetched(False)
-        return node
-
-
-class ComposerAlbumSongsFetcher(AlbumFetcher):
+    # Songs by title.
 
-    def __init__(self, composer, album):
-        super(ComposerAlbumSongsFetcher, self).__init__()
-        self.composer = composer
-        self.album = album
+    def sortedSongs(self, snapshot, query):
+        if len(query) == 0:
+            return Library.titleOrder(snapshot)
+        return super(AllSongsFetcher, self).sortedSongs(snapshot, query)
 
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "composer", self.composer):
-            if Parser.match(song, "album", self.album):
-                songList.append(song)
-        return songList
 
+class AlbumFetcher(SongsFetcher):
 
-class GenreSongsFetcher(AllSongsFetcher):
+    # Songs by disc and track.
 
-    def __init__(self, genre):
-        super(GenreSongsFetcher, self).__init__()
-        self.genre = genre
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "genre", self.genre):
-            songList.append(song)
-        return songList
-
-
-class ArtistSongsFetcher(AllSongsFetcher):
-
-    def __init__(self, artist):
-        super(ArtistSongsFetcher, self).__init__()
-        self.artist = artist
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "artist", self.artist):
-            songList.append(song)
-        return songList
-
-
-class ComposerSongsFetcher(AllSongsFetcher):
-
-    def __init__(self, composer):
-        super(ComposerSongsFetcher, self).__init__()
-        self.composer = composer
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "composer", self.composer):
-            songList.append(song)
-        return songList
-
-
-class GenreArtistSongsFetcher(AllSongsFetcher):
-
-    def __init__(self, genre, artist):
-        super(GenreArtistSongsFetcher, self).__init__()
-        self.genre = genre
-        self.artist = artist
-
-    def songs(self):
-        songList = []
-        for song in Client.cmd("find", "artist", self.artist):
-            if "genre" in song and song["genre"] == self.genre:
-                songList.append(song)
-        return songList
+    def key(self, table):
+        return table.sortKey
 
 
 class PlaylistSongsFetcher(SongsFetcher):
 
-    def __init__(self, playlist):
-        super(PlaylistSongsFetcher, self).__init__()
-        self.playlist = playlist
+    # A stored playlist has a table of its own, which StoredPlaylists keeps
+    # until the playlist is modified.
 
-    def preFetch(self):
-        for song in Client.cmd("listplaylistinfo", self.playlist):
-            self.addNode(self.createNode(song))
+    def preFetch(self, node):
+        table = StoredPlaylists.songs(node.playlist())
+        for row in xrange(len(table)):
+            node.addNode(SongNode(table, row, node))
 
-    def setPlaylist(self, playlist):
-        self.playlist = playlist
+
+# What each tab's nodes fetch, and what their children fetch in turn.
+ALL_SONGS = AllSongsFetcher()
+ALBUM_SONGS = AlbumFetcher()
+PLAYLIST_SONGS = PlaylistSongsFetcher()
+ALBUMS = TagsFetcher("album", "All Songs", ALL_SONGS, ALBUM_SONGS)
+ARTISTS = TagsFetcher("artist", "All Albums", ALBUMS, ALBUMS)
+GENRE_ARTISTS = TagsFetcher("artist", "All", ALL_SONGS, ALBUMS)
+GENRES = TagsFetcher("genre", "All Artists", ARTISTS, GENRE_ARTISTS)
+COMPOSERS = TagsFetcher("composer", "All Albums", ALBUMS, ALBUMS)
 
 
 class AllUris(object):
@@ -1055,14 +2060,35 @@ class OneUri(object):
 
 class DatabaseModel(QtCore.QAbstractItemModel):
 
+    NO_DATA = QtCore.QVariant()
+
+    # The icons and the font are the same for every node of a kind, so
+    # they're made once, keyed on (isLeaf, role), and shared by every
+    # model. Icons can't be made before the application is, so this is
+    # filled in by the first model.
+    roleData = None
+
     def __init__(self, root, uriFetcher, parent = None):
         super(DatabaseModel, self).__init__(parent)
         self.root = root
         self.uriFetcher = uriFetcher
+        if DatabaseModel.roleData is None:
+            DatabaseModel.roleData = DatabaseModel.createRoleData()
 
         # We do not fetch yet.
         self.root.setFetched(True)
 
+    @classmethod
+    def createRoleData(cls):
+        font = QtGui.QFont()
+        font.setBold(True)
+        return {\
+        (True, QtCore.Qt.DecorationRole):\
+        QtCore.QVariant(QtGui.QIcon(kdeui.KIcon("audio-x-generic"))),\
+        (False, QtCore.Qt.DecorationRole):\
+        QtCore.QVariant(QtGui.QIcon(kdeui.KIcon("folder-sound"))),\
+        (False, QtCore.Qt.FontRole): QtCore.QVariant(font)}
+
     def setConnector(self, connector):
         self.connector = connector
 
@@ -1084,19 +2110,81 @@ class DatabaseModel(QtCore.QAbstractItemModel):
         return not node.isLeaf()
 
     def canFetchMore(self, parent):
-        return not self.node(parent).isFetched()
+        node = self.node(parent)
+        return not node.isFetched() or node.hasPending()
 
     def fetchMore(self, parent):
-        try:
-            node = self.node(parent)
-            node.setFetched(True)
-            node.preFetch()
+        node = self.node(parent)
+
+        if node.isFetched():
+            # The next page of a streamed fetch. Everything it needs is
+            # already in memory.
+            node.fetchPage()
+            first = node.childCount()
+            if node.insertCount() > 0:
+                self.beginInsertRows(parent, first,\
+                first + node.insertCount() - 1)
+                node.postFetch()
+                self.endInsertRows()
+            else:
+                node.postFetch()
+            return
+
+        # The fetch itself runs on the connector's FetchThread. Until it
+        # comes back to insertFetched, the node shows a placeholder.
+        token = node.startFetch()
+        self.removeChildren(parent, node)
+        self.beginInsertRows(parent, 0, 0)
+        node.setChildren([LoadingNode(node)])
+        self.endInsertRows()
+        self.connector.fetch(self, node, token)
+
+    def insertFetched(self, node, token):
+        if node.token <> token or not self.attached(node):
+            return
+        parent = self.indexOf(node)
+        self.removeChildren(parent, node)
+        if node.insertCount() > 0:
             self.beginInsertRows(parent, 0, node.insertCount() - 1)
             node.postFetch()
             self.endInsertRows()
-        except (MPDError, socket.error) as e:
-            self.emit(QtCore.SIGNAL("broken"), str(e))
-            self.connector.setBroken(e)
+
+    def fetchFailed(self, node, token):
+        # Takes the placeholder away and collapses the node, which is
+        # fetched again on its next expansion. The root can't be collapsed,
+        # and is left empty rather than fetched again straight away.
+        # Returns whether the fetch was still wanted.
+        if node.token <> token or not self.attached(node):
+            return False
+        parent = self.indexOf(node)
+        self.removeChildren(parent, node)
+        if node is not self.root:
+            node.setFetched(False)
+            self.emit(QtCore.SIGNAL("isExpanded"), parent, False)
+        return True
+
+    def removeChildren(self, parent, node):
+        if node.childCount() > 0:
+            self.beginRemoveRows(parent, 0, node.childCount() - 1)
+            node.setChildren([])
+            self.endRemoveRows()
+
+    def attached(self, node):
+        # Whether the node is still in the tree. It may have been dropped
+        # while its fetch was running.
+        while node is not self.root:
+            parent = node.parent()
+            if parent is None or node.row() >= parent.childCount():
+                return False
+            if parent[node.row()] is not node:
+                return False
+            node = parent
+        return True
+
+    def indexOf(self, node):
+        if node is self.root:
+            return QtCore.QModelIndex()
+        return self.createIndex(node.row(), 0, node)
 
     def parent(self, index):
         if not index.isValid():
@@ -1118,7 +2206,8 @@ class DatabaseModel(QtCore.QAbstractItemModel):
 
     def flags(self, index):
         flags = QtCore.Qt.ItemIsEnabled
-        if self.node(index).isLeaf():
+        node = self.node(index)
+        if node.isLeaf() and not node.isLoading():
             flags = flags | QtCore.Qt.ItemIsSelectable
             flags = flags | QtCore.Qt.ItemIsDragEnabled
         return flags
@@ -1137,32 +2226,22 @@ class DatabaseModel(QtCore.QAbstractItemModel):
 
     def data(self, index, role):
         if not index.isValid():
-            return QtCore.QVariant()
+            return DatabaseModel.NO_DATA
 
+        node = index.internalPointer()
         if role == QtCore.Qt.DisplayRole:
-            return self.node(index).data()
-
-        if self.node(index).isLeaf():
-            if role == QtCore.Qt.DecorationRole:
-                # My C++ knowledge helped me solve this.
-                icon = QtGui.QIcon(kdeui.KIcon("audio-x-generic"))
-                return QtCore.QVariant(icon)
-        else:
-            if role == QtCore.Qt.FontRole:
-                font = QtGui.QFont()
-                font.setBold(True)
-                return QtCore.QVariant(font)
-            if role == QtCore.Qt.DecorationRole:
-                icon = QtGui.QIcon(kdeui.KIcon("folder-sound"))
-                return QtCore.QVariant(icon)
+            return node.data()
 
+        if node.isLoading():
+            return DatabaseModel.NO_DATA
 
-        return QtCore.QVariant()
+        return DatabaseModel.roleData.get((node.isLeaf(), role),\
+        DatabaseModel.NO_DATA)
 
     # Respond to doubleclick
     def sendUris(self, index):
         node = self.node(index)
-        if node.isLeaf():
+        if node.isLeaf() and not node.isLoading():
             uriToPlay, uris = self.uriFetcher.fetchUris(self.node(index))
             self.emit(QtCore.SIGNAL("uris"), uriToPlay, uris)
 
@@ -1184,7 +2263,7 @@ class PlaylistsModel(DatabaseModel):
 
         # It doesn't matter which fetcher we choose, because we never use
         # it.
-        super(PlaylistsModel, self).__init__(FetchingNode(AllSongsFetcher()),\
+        super(PlaylistsModel, self).__init__(FetchingNode(ALL_SONGS),\
         uriFetcher, parent)
 
     def clientConnect(self):
@@ -1195,43 +2274,111 @@ class PlaylistsModel(DatabaseModel):
         self.connector = connector
 
     def setPlaylists(self, playlists):
-        oldSize = self.root.childCount()
-        newSize = len(playlists)
-
-        # First we trim to size
-        if newSize < oldSize:
-            self.beginRemoveRows(QtCore.QModelIndex(), newSize,\
-            oldSize - 1)
-            del self.root.children[newSize:oldSize]
-            self.endRemoveRows()
-
-        # Then we add what we need to
-        if oldSize < newSize:
-            self.beginInsertRows(QtCore.QModelIndex(), oldSize, newSize - 1)
-            for i in xrange(oldSize, newSize):
-                self.root.children.append(PlaylistNode(playlists[i],\
-                self.root))
+        # Playlists are matched by name, so that adding, removing or
+        # renaming one leaves the rest alone. Those that haven't been
+        # modified keep their fetched songs and stay expanded.
+        root = self.root
+        top = QtCore.QModelIndex()
+        wanted = dict((playlist["playlist"], playlist)\
+        for playlist in playlists)
+
+        # First the removals, from the bottom up, a run at a time.
+        end = root.childCount()
+        while end > 0:
+            start = end
+            while start > 0 and not root[start - 1].playlist() in wanted:
+                start = start - 1
+            if start < end:
+                self.beginRemoveRows(top, start, end - 1)
+                root.deleteChildren(start, end)
+                self.endRemoveRows()
+                end = start
+            else:
+                end = end - 1
+
+        # Then the survivors are put in the new order, if they aren't in it
+        # already. Both lists are sorted the same way, so they usually are.
+        # The longest run of them that is in order stays put, and each of
+        # the others is moved to just after the one it follows.
+        nodes = dict((node.playlist(), node) for node in root.children)
+        order = [playlist["playlist"] for playlist in playlists\
+        if playlist["playlist"] in nodes]
+        kept = self.inOrder(order, [node.playlist() for node in root.children])
+        for i, name in enumerate(order):
+            if name in kept:
+                continue
+            row = nodes[name].row()
+            after = 0
+            if i > 0:
+                after = nodes[order[i - 1]].row() + 1
+            if row == after:
+                continue
+            self.beginMoveRows(top, row, row, top, after)
+            node = root[row]
+            root.deleteChildren(row, row + 1)
+            if row < after:
+                after = after - 1
+            root.insertChildren(after, [node])
+            self.endMoveRows()
+
+        # Then the insertions, a run at a time. Every row above the one
+        # being looked at now matches the new list.
+        i = 0
+        while i < len(playlists):
+            if playlists[i]["playlist"] in nodes:
+                i = i + 1
+                continue
+            j = i
+            while j < len(playlists) and\
+            not playlists[j]["playlist"] in nodes:
+                j = j + 1
+            self.beginInsertRows(top, i, j - 1)
+            root.insertChildren(i, [PlaylistNode(playlist, root)\
+            for playlist in playlists[i:j]])
             self.endInsertRows()
-
-        # Then we check what's changed.
-        for i in xrange(newSize):
-            namesMatch = self.root[i].playlist() == playlists[i]["playlist"]
-            datesMatch = self.root[i].modified() == \
-            playlists[i]["last-modified"]
-
-            index = None
-            if not namesMatch or not datesMatch:
-                index = self.createIndex(i, 0, self.root[i])
-            if not namesMatch:
-                self.root[i].setPlaylist(playlists[i]["playlist"])
-                self.root[i].setModified(playlists[i]["last-modified"])
-                self.root[i].fetcher.playlist = playlists[i]["playlist"]
+            i = j
+
+        # Finally, the modified playlists are collapsed, to be fetched
+        # again on their next expansion.
+        for node in root.children:
+            modified = wanted[node.playlist()]["last-modified"]
+            if node.modified() <> modified:
+                node.setModified(modified)
+                node.setFetched(False)
+                index = self.createIndex(node.row(), 0, node)
                 self.emit(QtCore.SIGNAL(\
-                "dataChanged(QModelIndex, QModelIndex"), index, index)
-            if index:
-                self.root[i].setFetched(False)
+                "dataChanged(QModelIndex, QModelIndex)"), index, index)
                 self.emit(QtCore.SIGNAL("isExpanded"), index, False)
 
+    def inOrder(self, order, names):
+        # The names making up a longest subsequence of names that is in the
+        # same order as in order. Both hold the same names.
+        wanted = dict((name, i) for i, name in enumerate(order))
+        # tails[k] is the position in names ending the increasing run of
+        # k + 1 with the smallest last index, which is ends[k], and
+        # previous links each position to the one before it in its run.
+        tails = []
+        ends = []
+        previous = [None] * len(names)
+        for position, name in enumerate(names):
+            k = bisect.bisect_left(ends, wanted[name])
+            if k > 0:
+                previous[position] = tails[k - 1]
+            if k == len(tails):
+                tails.append(position)
+                ends.append(wanted[name])
+            else:
+                tails[k] = position
+                ends[k] = wanted[name]
+        kept = set()
+        position = None
+        if len(tails) > 0:
+            position = tails[-1]
+        while position is not None:
+            kept.add(names[position])
+            position = previous[position]
+        return kept
+
     def flags(self, index):
         flags = super(PlaylistsModel, self).flags(index)
         if index.isValid() and not self.node(index).isLeaf():
@@ -1277,7 +2424,7 @@ class DatabaseView(QtGui.QTreeView):
         self.connect(self, QtCore.SIGNAL("doubleClicked(QModelIndex)"),\
         model.sendUris)
 
-        # Used only in the Playlists Model.
+        # Used by the Playlists Model, and when a fetch fails.
         self.connect(model, QtCore.SIGNAL("isExpanded"), self.setExpanded)
         QtGui.QTreeView.setModel(self, model)
 
@@ -1347,24 +2494,249 @@ class PlaylistsDelegate(QtGui.QStyledItemDelegate):
         editor.setText(index.internalPointer().nodeData["playlist"])
 
     def setModelData(self, editor, model, index):
-        name = unicode(editor.text()).strip()
+        # Playlist names are kept as MPD sends them, in UTF-8.
+        name = unicode(editor.text()).strip().encode("utf-8")
         if model.root[index.row()].playlist() == name:
             return
         if PlaylistSaver.isOkay(name, self.parent()):
             model.rename(index, name)
 
 
+class SongCache(object):
+
+    # Metadata for the songs in the queue, keyed by songid. A songid names
+    # one entry in the queue, and its metadata doesn't change for as long
+    # as the entry is there, so the cache only has to learn about new ids
+    # and forget removed ones.
+
+    # With more new ids than this, one playlistinfo for the whole queue is
+    # cheaper than a playlistid for each.
+    PREFETCH_LIMIT = 500
+
+    def __init__(self):
+        self.songs = {}
+        # The ids asked for with lookup that haven't arrived yet.
+        self.requested = set()
+        # Tooltip text, made the first time each song's is asked for.
+        self.tooltips = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.songs.clear()
+        self.requested.clear()
+        self.tooltips.clear()
+
+    def fill(self):
+        # One playlistinfo instead of one playlistid per row.
+        self.songs.clear()
+        self.tooltips.clear()
+        self.store(Client.cmd("playlistinfo"))
+
+    def store(self, songs):
+        for song in songs:
+            self.songs[int(song["id"])] = Parser.normalize(song)
+
+    def time(self, id):
+        # The song's length if we have it, 0 if we don't. Never fetches.
+        song = self.songs.get(id)
+        if song is None:
+            return 0
+        return song["time"]
+
+    def lookup(self, id, callback, row):
+        # Returns the song's metadata, but never waits. On a miss it
+        # returns None and asks for the song, and callback(id, row) is
+        # called once the song has arrived, with the row it was asked for
+        # from.
+        if id in self.songs:
+            self.hits = self.hits + 1
+            return self.songs[id]
+        if not id in self.requested:
+            self.misses = self.misses + 1
+            self.requested.add(id)
+            Client.send("playlistid", id).then(\
+            lambda songs: self.arrived(id, songs, callback, row),\
+            lambda e: self.requested.discard(id))
+        return None
+
+    def arrived(self, id, songs, callback, row):
+        # Songs that left the queue while they were on their way aren't
+        # wanted any more.
+        if not id in self.requested:
+            return
+        self.requested.discard(id)
+        self.store(songs)
+        callback(id, row)
+
+    def prefetch(self, ids):
+        # Fetches everything in ids that we don't have yet in one command
+        # list, or the whole queue with playlistinfo if there are too many.
+        # ids has to be the whole queue.
+        missing = [id for id in ids if id not in self.songs]
+        if len(missing) > SongCache.PREFETCH_LIMIT:
+            self.misses = self.misses + len(missing)
+            self.fill()
+        elif len(missing) > 0:
+            self.misses = self.misses + len(missing)
+            commands = [("playlistid", id) for id in missing]
+            for result in Client.cmdList(commands):
+                self.store(result)
+
+    def refresh(self, ids, version):
+        # Called with the new contents of the queue after plchangesposid.
+        # Entries that left the queue are dropped, and entries that joined
+        # it are fetched in bulk.
+        current = set(ids)
+        self.requested.intersection_update(current)
+        if version == PlaylistModel.NO_VERSION:
+            self.fill()
+            return
+        for id in self.songs.keys():
+            if id not in current:
+                del self.songs[id]
+                self.tooltips.pop(id, None)
+        self.prefetch(ids)
+
+    def tooltip(self, id, callback, row):
+        # Never waits either. Returns None until the song has arrived.
+        if id in self.tooltips:
+            return self.tooltips[id]
+        song = self.lookup(id, callback, row)
+        if song is None:
+            return None
+        text = Parser.tooltip(song)
+        self.tooltips[id] = text
+        return text
+
+
+class DurationIndex(object):
+
+    # The lengths of the songs in the queue, by row, kept in step with
+    # PlaylistModel.ids in a Fenwick tree, so that the total of any range
+    # of rows takes O(log n). Setting or appending a row is O(log n) too,
+    # and so is dropping rows from the end. Inserting, deleting or moving
+    # anywhere else shifts every row after it, so the tree is rebuilt, in
+    # O(n). Deletes and moves come in batches, which are rebuilt for once.
+
+    def __init__(self):
+        self.times = []
+        # 1-based. tree[i] holds the total of the rows in
+        # [i - (i & -i), i).
+        self.tree = [0]
+
+    def __len__(self):
+        return len(self.times)
+
+    def clear(self):
+        self.times = []
+        self.tree = [0]
+
+    def prefix(self, row):
+        # The total of the rows before row.
+        total = 0
+        while row > 0:
+            total = total + self.tree[row]
+            row = row & (row - 1)
+        return total
+
+    def range(self, start, end):
+        return self.prefix(end) - self.prefix(start)
+
+    def total(self):
+        return self.prefix(len(self.times))
+
+    def set(self, row, time):
+        delta = time - self.times[row]
+        if delta == 0:
+            return
+        self.times[row] = time
+        i = row + 1
+        while i < len(self.tree):
+            self.tree[i] = self.tree[i] + delta
+            i = i + (i & -i)
+
+    def append(self, time):
+        i = len(self.times) + 1
+        self.times.append(time)
+        self.tree.append(time + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def extend(self, times):
+        for time in times:
+            self.append(time)
+
+    def truncate(self, size):
+        # The tree's entries below size only cover rows below size.
+        del self.times[size:]
+        del self.tree[size + 1:]
+
+    def insert(self, row, times):
+        if row >= len(self.times):
+            self.extend(times)
+            return
+        self.times[row:row] = times
+        self.rebuild()
+
+    def delete(self, start, end):
+        if end >= len(self.times):
+            self.truncate(start)
+            return
+        del self.times[start:end]
+        self.rebuild()
+
+    def deleteRuns(self, runs):
+        # Deletes [start, end) runs in the order given, the way
+        # PlaylistModel.deleteRows deletes ids.
+        if len(runs) == 1:
+            self.delete(runs[0][0], runs[0][1])
+            return
+        for start, end in runs:
+            del self.times[start:end]
+        self.rebuild()
+
+    def moveRuns(self, moves):
+        # Moves rows [start, end) so that they start at to, for each
+        # (start, end, to) in turn, the way PlaylistModel.moveRows moves
+        # ids.
+        for start, end, to in moves:
+            block = self.times[start:end]
+            del self.times[start:end]
+            self.times[to:to] = block
+        self.rebuild()
+
+    def rebuild(self):
+        tree = [0] + self.times
+        size = len(tree)
+        for i in xrange(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                tree[parent] = tree[parent] + tree[i]
+        self.tree = tree
+
+
 class PlaylistModel(QtCore.QAbstractItemModel):
 
     NO_VERSION = -32768
     NO_SONGID = -32768
 
+    # How many addid commands go into each command list.
+    BATCH_SIZE = 1000
+
     def __init__(self, combinedTimeLabel, parent = None):
         super(PlaylistModel, self).__init__(parent)
         self.ids = []
+        self.batchSize = PlaylistModel.BATCH_SIZE
+        self.songs = SongCache()
         self.version = PlaylistModel.NO_VERSION
         self.songid = PlaylistModel.NO_SONGID
         self.selectedLength = combinedTimeLabel
+        self.durations = DurationIndex()
+        # The row of the current song and how far into it we are, from the
+        # last status, and the selected rows, as [start, end) ranges. They
+        # make up the label.
+        self.songRow = None
+        self.elapsed = 0
+        self.selection = []
 
     def rowCount(self, parent = QtCore.QModelIndex()):
         return len(self.ids)
@@ -1386,6 +2758,11 @@ class PlaylistModel(QtCore.QAbstractItemModel):
             self.beginRemoveRows(QtCore.QModelIndex(), 0, size - 1)
             del self.ids[:]
             self.endRemoveRows()
+        self.songs.clear()
+        self.durations.clear()
+        self.songRow = None
+        self.selection = []
+        self.selectedLength.setText("")
 
     def data(self, index, role = QtCore.Qt.DisplayRole):
         try:
@@ -1393,9 +2770,12 @@ class PlaylistModel(QtCore.QAbstractItemModel):
                 return QtCore.QVariant()
 
             if role == QtCore.Qt.DisplayRole:
-                song = Client.cmd("playlistid", self.ids[index.row()])[0]
+                song = self.songs.lookup(self.ids[index.row()],\
+                self.songArrived, index.row())
+                if song is None:
+                    return QtCore.QVariant()
                 if index.column() == 0:
-                    return QtCore.QVariant(Parser.title(song).decode("utf-8"))
+                    return QtCore.QVariant(Parser.title(song))
                 if index.column() == 1:
                     return QtCore.QVariant(Parser.length(song))
 
@@ -1413,6 +2793,19 @@ class PlaylistModel(QtCore.QAbstractItemModel):
         except (MPDError, socket.error) as e:
             return QtCore.QVariant()
 
+    def songArrived(self, id, row):
+        # The row is where the song was asked for from. Only if the queue
+        # has changed since is it looked for.
+        if row >= len(self.ids) or self.ids[row] <> id:
+            try:
+                row = self.ids.index(id)
+            except ValueError:
+                return
+        self.durations.set(row, self.songs.time(id))
+        self.emit(QtCore.SIGNAL("dataChanged(QModelIndex, QModelIndex)"),\
+        self.index(row, 0, QtCore.QModelIndex()),\
+        self.index(row, 1, QtCore.QModelIndex()))
+
     def flags(self, index):
         f = QtCore.Qt.NoItemFlags
         if index.isValid():
@@ -1454,18 +2847,7 @@ class PlaylistModel(QtCore.QAbstractItemModel):
                 srcIndexes = []
                 while not stream.atEnd():
                     srcIndexes.append(stream.readUInt16())
-                srcIndexes.sort()
-
-                # You don't want to know how long this took.
-                srcOffset = 0
-                destOffset = 0
-                for srcIndex in srcIndexes:
-                    if srcIndex < row:
-                        self.move(srcIndex - srcOffset, row - 1)
-                        srcOffset = srcOffset + 1
-                    else:
-                        self.move(srcIndex, row + destOffset)
-                        destOffset = destOffset + 1
+                self.moveRows(srcIndexes, row)
 
             if data.hasFormat("application/x-quetzalcoatl-uris"):
                 encodedData = data.data("application/x-quetzalcoatl-uris")
@@ -1477,14 +2859,22 @@ class PlaylistModel(QtCore.QAbstractItemModel):
                     insertAt = 0
                 else:
                     insertAt = row
+                uris = []
                 while not stream.atEnd():
-                    uri = stream.readString()
+                    uris.append(stream.readString())
+
+                # The whole drop goes to the server before the view hears
+                # about any of it, and then arrives as one insertion.
+                ids = []
+                for batch in self.addBatches(uris, insertAt):
+                    ids.extend(batch)
+                if len(ids) > 0:
                     self.beginInsertRows(QtCore.QModelIndex(), insertAt,\
-                    insertAt)
-                    id = Client.cmd("addid", uri, insertAt)
-                    self.ids.insert(insertAt, id)
+                    insertAt + len(ids) - 1)
+                    self.ids[insertAt:insertAt] = ids
+                    self.durations.insert(insertAt,\
+                    [self.songs.time(id) for id in ids])
                     self.endInsertRows()
-                    insertAt = insertAt + 1
                 self.emit(QtCore.SIGNAL("saveable"), True)
         except (MPDError, socket.error) as e:
             self.connector.setBroken(e)
@@ -1502,31 +2892,63 @@ class PlaylistModel(QtCore.QAbstractItemModel):
             return self.createIndex(row, column, -1)
         return QtCore.QModelIndex()
 
-    def move(self, srcIndex, destIndex):
+    def blockMoves(self, rows, row):
+        # Works out the moves that gather the rows, in order, into one block
+        # at row, as (start, end, to) ranges. Adjacent rows are moved
+        # together. Runs above row are stacked just above it, bottom run
+        # first, and runs below it are stacked after those, top run first.
+        # Done in that order, no move shifts a run that is still to come.
+
+        runs = []
+        for r in sorted(set(rows)):
+            if len(runs) > 0 and r == runs[-1][1] and r <> row:
+                runs[-1][1] = r + 1
+            else:
+                runs.append([r, r + 1])
+
+        moves = []
+        blockStart = row
+        for start, end in reversed([run for run in runs if run[0] < row]):
+            to = blockStart - (end - start)
+            if start <> to:
+                moves.append((start, end, to))
+            blockStart = to
+        blockEnd = row
+        for start, end in [run for run in runs if run[0] >= row]:
+            if start <> blockEnd:
+                moves.append((start, end, blockEnd))
+            blockEnd = blockEnd + end - start
+        return moves
+
+    def moveRows(self, rows, row):
         # Exceptions are caught in the calling method.
 
-        if srcIndex == destIndex:
+        moves = self.blockMoves(rows, row)
+        if len(moves) == 0:
             return
 
-        id = self.ids[srcIndex]
-        Client.cmd("moveid", id, destIndex)
-        if srcIndex < destIndex:
-            step = 1
-            firstIndex = srcIndex
-            lastIndex = destIndex
-        else:
-            step = -1
-            firstIndex = destIndex
-            lastIndex = srcIndex
-        for i in xrange(srcIndex, destIndex, step):
-            self.ids[i] = self.ids[i + step]
-        self.ids[destIndex] = id
-        self.emit(QtCore.SIGNAL(\
-        "dataChanged(QModelIndex, QModelIndex)"),\
-        self.index(firstIndex, 0, QtCore.QModelIndex()),\
-        self.index(lastIndex, 1, QtCore.QModelIndex()))
-
-    def update(self, status):
+        Client.cmdList([("move", "%d:%d" % (start, end), to)\
+        for start, end, to in moves])
+
+        self.emit(QtCore.SIGNAL("layoutAboutToBeChanged()"))
+        oldIds = self.ids[:]
+        for start, end, to in moves:
+            block = self.ids[start:end]
+            del self.ids[start:end]
+            self.ids[to:to] = block
+        self.durations.moveRuns(moves)
+        persistent = self.persistentIndexList()
+        if len(persistent) > 0:
+            rows = dict((id, i) for i, id in enumerate(self.ids))
+            for index in persistent:
+                newRow = rows[oldIds[index.row()]]
+                self.changePersistentIndex(index,\
+                self.index(newRow, index.column(), QtCore.QModelIndex()))
+        self.emit(QtCore.SIGNAL("layoutChanged()"))
+
+    def update(self, status, song = None, changes = None):
+        # changes is (version, plchangesposid since that version), if the
+        # connector fetched them along with the status.
         version = int(status["playlist"])
         size = int(status["playlistlength"])
 
@@ -1537,8 +2959,12 @@ class PlaylistModel(QtCore.QAbstractItemModel):
                     self.beginRemoveRows(QtCore.QModelIndex(), size,\
                     oldSize - 1)
                     del self.ids[size:oldSize]
+                    self.durations.truncate(size)
                     self.endRemoveRows()
-                changes = Client.cmd("plchangesposid", self.version)
+                if changes is not None and changes[0] == self.version:
+                    changes = changes[1]
+                else:
+                    changes = Client.cmd("plchangesposid", self.version)
                 changes.sort(self.posCmp)
                 for posid in changes:
                     pos = int(posid["cpos"])
@@ -1553,7 +2979,13 @@ class PlaylistModel(QtCore.QAbstractItemModel):
                         self.beginInsertRows(QtCore.QModelIndex(),
                         len(self.ids), len(self.ids))
                         self.ids.append(id)
+                        self.durations.append(0)
                         self.endInsertRows()
+                self.songs.refresh(self.ids, self.version)
+                # The changed rows' songs are all cached by now.
+                for posid in changes:
+                    self.durations.set(int(posid["cpos"]),\
+                    self.songs.time(int(posid["id"])))
                 self.version = version
             if "songid" in status:
                 songid = int(status["songid"])
@@ -1569,6 +3001,13 @@ class PlaylistModel(QtCore.QAbstractItemModel):
                     self.index(i, 1, QtCore.QModelIndex()))
                 except:
                     pass
+            self.songRow = None
+            if "song" in status:
+                self.songRow = int(status["song"])
+            self.elapsed = 0
+            if "time" in status:
+                self.elapsed = Parser.elapsed(status)
+            self.showTimes()
             self.emit(QtCore.SIGNAL("saveable"), size > 0)
         except (MPDError, socket.error) as e:
             self.connector.setBroken(e)
@@ -1617,58 +3056,80 @@ class PlaylistModel(QtCore.QAbstractItemModel):
 
     def deleteRows(self, rows):
 
-        # We speed things up by looking for runs.
-
-        run = []
-        offset = 0
+        # We speed things up by looking for runs. Each run becomes a single
+        # ranged delete, and all of them go out in one command list. The
+        # runs are deleted from the bottom up, so that deleting one never
+        # shifts the positions of the ones still to come.
 
+        runs = []
         for row in sorted(rows):
-            if len(run) == 0:
-                run = [row]
-
-            elif row - run[-1] == 1:
-                run.append(row)
+            if len(runs) > 0 and row == runs[-1][1]:
+                runs[-1][1] = row + 1
             else:
-                str(run[-1] - offset)
-                self.beginRemoveRows(QtCore.QModelIndex(), run[0] - offset,\
-                run[-1] - offset)
-                for rowInRun in run:
-                    id = self.ids[rowInRun - offset]
-                    if id == self.songid:
-                        self.emit(QtCore.SIGNAL("stopped"))
-                    Client.cmd("deleteid", id)
-                del self.ids[run[0] - offset: run[-1] - offset + 1]
+                runs.append([row, row + 1])
+        runs.reverse()
+
+        if len(runs) == 0:
+            return
+
+        try:
+            stopping = False
+            for start, end in runs:
+                if self.songid in self.ids[start:end]:
+                    stopping = True
+
+            Client.cmdList([("delete", "%d:%d" % (start, end))\
+            for start, end in runs])
+
+            # The durations are caught up once, at the end. Until then
+            # they run past the end of the queue, which is harmless.
+            for start, end in runs:
+                self.beginRemoveRows(QtCore.QModelIndex(), start, end - 1)
+                del self.ids[start:end]
                 self.endRemoveRows()
-                offset = offset + len(run)
-                run = [row]
-                print "We start a new run: " + str(run)
-        str(run[-1] - offset)
-        self.beginRemoveRows(QtCore.QModelIndex(), run[0] - offset,\
-        run[-1] - offset)
-        for rowInRun in run:
-            id = self.ids[rowInRun - offset]
-            if id == self.songid:
+            self.durations.deleteRuns(runs)
+            self.showTimes()
+
+            if stopping:
                 self.emit(QtCore.SIGNAL("stopped"))
-            Client.cmd("deleteid", id)
-        del self.ids[run[0] - offset: run[-1] - offset + 1]
-        self.endRemoveRows()
+            self.emit(QtCore.SIGNAL("saveable"), len(self.ids) > 0)
+        except (MPDError, socket.error) as e:
+            self.connector.setBroken(e)
 
-        self.emit(QtCore.SIGNAL("saveable"), len(self.ids) > 0)
+    def addBatches(self, uris, position = None):
+        # Sends the addids batchSize at a time, each batch as one command
+        # list, and yields the new ids batch by batch. Given a position, the
+        # songs are inserted there instead of appended.
+        # Exceptions are caught in the calling method.
+        for start in xrange(0, len(uris), self.batchSize):
+            batch = uris[start:start + self.batchSize]
+            if position is None:
+                commands = [("addid", uri) for uri in batch]
+            else:
+                commands = [("addid", uri, position + start + i)\
+                for i, uri in enumerate(batch)]
+            yield [int(id) for id in Client.cmdList(commands)]
 
     def setUris(self, uriToPlay, uris):
         try:
-            self.beginRemoveRows(QtCore.QModelIndex(), 0, len(self.ids) - 1)
+            if len(self.ids) > 0:
+                self.beginRemoveRows(QtCore.QModelIndex(), 0,\
+                len(self.ids) - 1)
+                del self.ids[:]
+                self.durations.clear()
+                self.endRemoveRows()
             Client.cmd("clear")
-            del self.ids[:]
-            self.endRemoveRows()
 
             rowToPlay = -1
-            self.beginInsertRows(QtCore.QModelIndex(), 0, len(uris) - 1)
-            for row in xrange(len(uris)):
-                self.ids.append(Client.cmd("addid", uris[row]))
-                if uris[row] == uriToPlay:
-                    rowToPlay = row
-            self.endInsertRows()
+            if uriToPlay in uris:
+                rowToPlay = uris.index(uriToPlay)
+            for ids in self.addBatches(uris):
+                size = len(self.ids)
+                self.beginInsertRows(QtCore.QModelIndex(), size,\
+                size + len(ids) - 1)
+                self.ids.extend(ids)
+                self.durations.extend([self.songs.time(id) for id in ids])
+                self.endInsertRows()
             self.playRow(rowToPlay)
             self.emit(QtCore.SIGNAL("saveable"), True)
         except (MPDError, socket.error) as e:
@@ -1691,23 +3152,44 @@ class PlaylistModel(QtCore.QAbstractItemModel):
             return False
         return True
 
-    def song(self, index):
-        try:
-            return Client.cmd("playlistid", self.ids[index.row()])[0]
-        except (MPDError, socket.error) as e:
-            self.connector.setBroken(e)
-
-    def showCombinedTime(self, indexes):
-        # We catch exceptions in the calling method
-
-        if len(indexes) > 0:
+    def tooltip(self, index):
+        return self.songs.tooltip(self.ids[index.row()], self.songArrived,\
+        index.row())
+
+    def showCombinedTime(self, ranges):
+        # Takes the selection as [start, end) ranges of rows, which may
+        # overlap.
+        self.selection = []
+        for start, end in sorted(ranges):
+            if len(self.selection) > 0 and start <= self.selection[-1][1]:
+                self.selection[-1][1] = max(end, self.selection[-1][1])
+            else:
+                self.selection.append([start, end])
+        self.showTimes()
+
+    def timeUntil(self, row):
+        # How long until row starts playing, or None if it won't without
+        # skipping.
+        if self.songRow is None or row <= self.songRow:
+            return None
+        return max(0, self.durations.range(self.songRow, row) - self.elapsed)
+
+    def showTimes(self):
+        # The selection's length, and how soon it starts, or without a
+        # selection the length of the whole queue.
+        if len(self.selection) > 0:
             time = 0
-            for index in indexes:
-                song = Client.cmd("playlistid", self.ids[index.row()])[0]
-                time = time + int(song["time"])
-            self.selectedLength.setText(Parser.prettyTime(time))
+            for start, end in self.selection:
+                time = time + self.durations.range(start, end)
+            text = "Selected: " + Parser.prettyTime(time)
+            until = self.timeUntil(self.selection[0][0])
+            if until is not None:
+                text = text + ", starts in " + Parser.prettyTime(until)
+        elif len(self.durations) > 0:
+            text = "Queue: " + Parser.prettyTime(self.durations.total())
         else:
-            self.selectedLength.setText("")
+            text = ""
+        self.selectedLength.setText(text)
 
 
 class PlaylistView(QtGui.QTreeView):
@@ -1761,6 +3243,12 @@ class PlaylistView(QtGui.QTreeView):
         self.connect(self.selectionModel(),\
         QtCore.SIGNAL("selectionChanged(QItemSelection, QItemSelection)"),\
         self.setLabel)
+        # Rows coming and going shift the selection without changing it,
+        # as far as selectionChanged is concerned. The selection model has
+        # caught up by the time these arrive, since it connected first.
+        for signal in ("rowsInserted(QModelIndex, int, int)",\
+        "rowsRemoved(QModelIndex, int, int)", "layoutChanged()"):
+            self.connect(model, QtCore.SIGNAL(signal), self.resetLabel)
 
     def play(self):
 
@@ -1783,29 +3271,22 @@ class PlaylistView(QtGui.QTreeView):
 
             index = self.indexAt(event.pos())
 
+            # A song we don't have yet gets no tooltip this time. It's
+            # fetched without waiting, for the next.
             if index.isValid():
-                tags = [("artist", "Artists: "), ("album", "Album: "),\
-                ("genre", "Genre: "), ("composer", "Composer: ")]
-                text = ""
-                first = True
-                song = self.model().song(index)
-                for tag, header in tags:
-                    if Parser.hasKey(song, tag):
-                        if first:
-                            first = False
-                        else:
-                            text = text + "\n"
-                        text = text + header + Parser.parsedValue(song, tag)
-                if len(text) > 0:
+                text = self.model().tooltip(index)
+                if text:
                     QtGui.QToolTip.showText(event.globalPos(), text)
         return QtGui.QTreeView.viewportEvent(self, event)
 
     def setLabel(self, selected, deselected):
-        try:
-            self.model().showCombinedTime(\
-            self.selectionModel().selectedIndexes())
-        except (MPDError, socket.error) as e:
-            self.connector.setBroken(e)
+        # The ranges, rather than every selected index, so that selecting
+        # the whole queue costs no more than selecting one row.
+        self.model().showCombinedTime([(r.top(), r.bottom() + 1)\
+        for r in self.selectionModel().selection()])
+
+    def resetLabel(self, parent = None, start = None, end = None):
+        self.setLabel(None, None)
 
 
 class ConnectAction(QtGui.QAction):
@@ -1893,7 +3374,7 @@ class PlayPauseAction(QtGui.QAction):
         except (MPDError, socket.error) as e:
             self.connector.setBroken(e)
 
-    def update(self, status):
+    def update(self, status, song = None, changes = None):
 
         if status["state"] == "stop":
             self.setState(PlayPauseAction.STOPPED)
@@ -1982,7 +3463,7 @@ class ShuffleAction(QtGui.QAction):
         self.setChecked(False)
         self.setEnabled(False)
 
-    def update(self, status):
+    def update(self, status, song = None, changes = None):
         self.setChecked(status["random"] == "1")
 
 
@@ -2012,7 +3493,7 @@ class RepeatAction(QtGui.QAction):
         self.setChecked(False)
         self.setEnabled(False)
 
-    def update(self, status):
+    def update(self, status, song = None, changes = None):
         self.setChecked(status["repeat"] == "1")
 
 
@@ -2040,6 +3521,58 @@ class SaveAction(QtGui.QAction):
         self.setEnabled(False)
 
 
+class StatsDialog(kdeui.KDialog):
+
+    # Shows what Stats has recorded so far.
+
+    COLUMNS = ["Command", "Calls", "Bytes", "Mean (ms)", "Latencies"]
+
+    def __init__(self, parent = None):
+        super(StatsDialog, self).__init__(parent)
+
+        self.setCaption("Command Statistics")
+        self.setButtons(self.ButtonCode(self.Ok | self.User1))
+        self.setButtonText(self.User1, "Refresh")
+        self.table = QtGui.QTreeWidget(self)
+        self.table.setRootIsDecorated(False)
+        self.table.setHeaderLabels(StatsDialog.COLUMNS)
+        self.setMainWidget(self.table)
+        self.resize(700, 400)
+        self.connect(self, QtCore.SIGNAL("user1Clicked()"), self.refresh)
+
+    def exec_(self):
+        self.refresh()
+        kdeui.KDialog.exec_(self)
+
+    def refresh(self):
+        self.table.clear()
+        commands = Stats.snapshot()
+        for command in sorted(commands.keys()):
+            entry = commands[command]
+            item = QtGui.QTreeWidgetItem(self.table)
+            item.setText(0, command)
+            item.setText(1, str(entry["calls"]))
+            item.setText(2, str(entry["bytes"]))
+            item.setText(3, "%.2f" %\
+            (entry["seconds"] * 1000 / entry["calls"]))
+            item.setText(4, self.histogram(entry["histogram"]))
+        for column in xrange(len(StatsDialog.COLUMNS)):
+            self.table.resizeColumnToContents(column)
+
+    def histogram(self, counts):
+        # Only the buckets with something in them, by upper bound.
+        buckets = []
+        for bucket, count in enumerate(counts):
+            if count == 0:
+                continue
+            if bucket < len(Stats.BUCKETS):
+                label = "<%gms" % (Stats.BUCKETS[bucket] * 1000)
+            else:
+                label = "slower"
+            buckets.append("%s: %d" % (label, count))
+        return ", ".join(buckets)
+
+
 class PlaylistSaver(kdeui.KDialog):
 
     def __init__(self, parent = None):
@@ -2083,12 +3616,7 @@ class PlaylistSaver(kdeui.KDialog):
             "with a period.")
             return False
 
-        matched = False
-        for check in Client.cmd("listplaylists"):
-            if check["playlist"] == name:
-                matched = True
-                break
-        if matched:
+        if StoredPlaylists.exists(name):
             kdeui.KMessageBox.error(parent, "A playlist by that name "\
             "already exists.")
             return False
@@ -2177,6 +3705,12 @@ class UI(kdeui.KMainWindow):
         self.connector.addConnectable(saveAction)
         toolBar.addAction(saveAction)
 
+        if Stats.enabled:
+            self.statsDialog = StatsDialog(self)
+            toolBar.addSeparator()
+            toolBar.addAction(kdeui.KIcon("utilities-system-monitor"),\
+            "Command Statistics", self.statsDialog.exec_)
+
         centralWidget = QtGui.QWidget(self)
         self.setCentralWidget(centralWidget)
         layout = QtGui.QVBoxLayout()
@@ -2210,11 +3744,11 @@ class UI(kdeui.KMainWindow):
         self.tabs.addTab(view, "Playlists")
         self.dbModels.append(self.playlistsModel)
 
-        self.addTab(ArtistsFetcher(), AllUris(), "Artists")
-        self.addTab(AlbumsFetcher(), AllUris(), "Albums")
-        self.addTab(AllSongsFetcher(), OneUri(), "Songs")
-        self.addTab(GenresFetcher(), AllUris(), "Genres")
-        self.addTab(ComposersFetcher(), AllUris(), "Composers")
+        self.addTab(ARTISTS, AllUris(), "Artists")
+        self.addTab(ALBUMS, AllUris(), "Albums")
+        self.addTab(ALL_SONGS, OneUri(), "Songs")
+        self.addTab(GENRES, AllUris(), "Genres")
+        self.addTab(COMPOSERS, AllUris(), "Composers")
 
         self.playlistModel = PlaylistModel(combinedTime, self)
         self.connector.addConnectable(self.playlistModel,\
@@ -2241,6 +3775,7 @@ class UI(kdeui.KMainWindow):
 
     def clientDisconnect(self):
         self.status.showMessage("")
+        self.setWindowTitle("Quetzalcoatl")
         self.resetSlider()
 
     def setSongTime(self, value):
@@ -2259,7 +3794,14 @@ class UI(kdeui.KMainWindow):
         except (MPDError, socket.error) as e:
             self.connector.setBroken(e)
 
-    def update(self, status):
+    def update(self, status, song = None, changes = None):
+        # The song only comes with a refresh, not with the ticks in between.
+        if song is not None:
+            if Parser.isValid(song):
+                self.setWindowTitle(Parser.displayTitle(song) +\
+                " - Quetzalcoatl")
+            else:
+                self.setWindowTitle("Quetzalcoatl")
 
         if "time" in status:
             self.status.showMessage(Parser.prettyStatusTime(status))
@@ -2333,23 +3875,45 @@ class UI(kdeui.KMainWindow):
         self.isDragging = False
 
 
-appName = "Quetzalcoatl"
-catalog = ""
-programName = kdecore.ki18n("Quetzalcoatl")
-version = "1.0"
-description = kdecore.ki18n("mpd client")
-license = kdecore.KAboutData.License_GPL
-copyright = kdecore.ki18n("(c) 2009 Dugan Chen")
-text = kdecore.ki18n("none")
-homePage = "www.vcn.bc.ca/~dugan/"
-bugEmail = "see homepage"
-
-aboutData = kdecore.KAboutData(appName, catalog, programName, version,\
-description, license, copyright, text, homePage, bugEmail)
-
-kdecore.KCmdLineArgs.init(sys.argv, aboutData)
-app = kdeui.KApplication()
-client = MPDClient()
-main = UI(client)
-main.show()
-sys.exit(app.exec_())
+if __name__ == "__main__":
+    appName = "Quetzalcoatl"
+    catalog = ""
+    programName = kdecore.ki18n("Quetzalcoatl")
+    version = "1.0"
+    description = kdecore.ki18n("mpd client")
+    license = kdecore.KAboutData.License_GPL
+    copyright = kdecore.ki18n("(c) 2009 Dugan Chen")
+    text = kdecore.ki18n("none")
+    homePage = "www.vcn.bc.ca/~dugan/"
+    bugEmail = "see homepage"
+
+    aboutData = kdecore.KAboutData(appName, catalog, programName, version,\
+    description, license, copyright, text, homePage, bugEmail)
+
+    kdecore.KCmdLineArgs.init(sys.argv, aboutData)
+    app = kdeui.KApplication()
+
+    # Setting QUETZALCOATL_RECORD to a file name records a trace of the
+    # session there, for benchmarks/replay.py.
+    if os.environ.get("QUETZALCOATL_RECORD"):
+        Recorder.enable(os.environ["QUETZALCOATL_RECORD"])
+
+    # Setting QUETZALCOATL_STATS to a file name turns on the command
+    # statistics, which are dumped there on exit and on SIGUSR1.
+    if os.environ.get("QUETZALCOATL_STATS"):
+        Stats.enable(os.environ["QUETZALCOATL_STATS"])
+        signal.signal(signal.SIGUSR1, lambda signum, frame: Stats.dump())
+        # Python only runs signal handlers when it gets control, which it
+        # doesn't while the event loop is idle.
+        signalTimer = QtCore.QTimer()
+        QtCore.QObject.connect(signalTimer, QtCore.SIGNAL("timeout()"),
+            lambda: None)
+        signalTimer.start(500)
+
+    client = MPDClient()
+    main = UI(client)
+    main.show()
+    result = app.exec_()
+    Stats.dump()
+    Recorder.stop()
+    sys.exit(result)